@@ -0,0 +1,49 @@
+# This script runs one of the Flexoscope processing pipelines headless
+# on a whole directory (or glob pattern) of .ome.tif files. The images
+# are processed by several Fiji worker processes at the same time, each
+# with its own memory limit. Results are saved as .tif in the output
+# directory; images with an existing result are skipped, so an
+# interrupted batch can be started again.
+#
+# Without a display, the settings are read from the command line instead
+# of a dialog:
+#
+#   fiji --headless --jython BatchFormat.py PATTERN OUTDIR PIPELINE [--workers N] [--memory 4g] [--cache DIR]
+#
+# Jorik van Rijn <jorik.vanrijn@gmail.com> - 2020
+
+import sys
+import ij.gui.GenericDialog as GenericDialog
+from java.awt import GraphicsEnvironment
+from FijiTools2020 import batch
+from FijiTools2020.batch import batchrun
+from FijiTools2020.pipelines import PIPELINES
+
+
+def main():
+    # A dialog can not be shown headless, read the command line instead.
+    if GraphicsEnvironment.isHeadless():
+        batch.main(["run"] + sys.argv[1:])
+        return
+
+    # Ask for the batch settings.
+    gd = GenericDialog("Batch Flexoscope processing")
+    gd.addStringField("Input directory or pattern", "", 40)
+    gd.addStringField("Output directory", "", 40)
+    gd.addChoice("Pipeline", sorted(PIPELINES), "gaussian")
+    gd.addNumericField("Workers", 2, 0)
+    gd.addStringField("Memory per worker", "4g")
+    gd.showDialog()
+    if gd.wasCanceled():
+        return
+
+    pattern = gd.getNextString()
+    outdir = gd.getNextString()
+    pipeline = gd.getNextChoice()
+    nworkers = int(gd.getNextNumber())
+    memory = gd.getNextString()
+
+    batchrun(pattern, outdir, pipeline, nworkers, memory)
+
+
+main()
@@ -15,6 +15,9 @@ import ij.plugin.StackCombiner as StackCombiner
 import ij.plugin.Duplicator as Duplicator
 import ij.plugin.Concatenator as Concatenator
 import os
+from FijiTools2020.fileHandling import (loadcsv, getcolumns, spotpositions, unpackpositions, parallelmap,
+                                         readthreads, usewriter, saveimage)
+from FijiTools2020.impActions import cropframes
 
 
 class CropTool(object):
@@ -32,23 +35,16 @@ class CropTool(object):
         # Return if the csv object was not set.
         # if self.trackscsv == None: return None TODO: some errorchecking for false csv input.
 
-        # Open the csv file and return it as ResultsTable object.
+        # Stream the csv file and return it as ResultsColumns table.
         try:
             csv = IJ.getFilePath("Choose the {} file".format(name))
 
             if csv.endswith(".csv"): 
-                rt = ResultsTable.open(csv)
+                table = loadcsv(csv)
             else: 
                 IJ.log("{} was not a .csv file".format(csv))
                 raise ValueError
 
-            columns = rt.getHeadings()
-            table = [{column: rt.getValue(column, row) for column in columns} for row in range(rt.size())]
-            
-            if rt.columnExists("Label"):
-                for i in range(len(table)):
-                    table[i]["Label"] = rt.getStringValue("Label", i)
-
             IJ.log("Read {} rows in {}.".format(len(table), name))
             return table
 
@@ -57,12 +53,15 @@ class CropTool(object):
 
 
     def croppoints(self, outdir, roi_x=150, roi_y=150, ntracks=None,
-                   trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y", tracktlocation="FRAME"):
+                   trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y", tracktlocation="FRAME",
+                   save=False, nthreads=None):
         """Function to follow and crop the individual spots within a trackmate "Spots statistics.csv" file.
 
+        Tracks are cropped (and optionally saved) in parallel. The cropped stacks are stored in track order.
+
         Args:
             imp (ImagePlus()): An ImagePlus() stack.
-            spots (list of dictionaries): The output of a getresults() function call.
+            spots (ResultsColumns): The output of a getresults() function call.
             outdir (path): The output directory path.
             roi_x (int, optional): ROI width (pixels). Defaults to 150.
             roi_y (int, optional): ROI height (pixels). Defaults to 150.
@@ -71,6 +70,8 @@ class CropTool(object):
             trackxlocation (str, optional): Column name of spot x location. Defaults to "POSITION_X".
             trackylocation (str, optional): Column name of spot y location. Defaults to "POSITION_Y".
             tracktlocation (str, optional): Column name of spot time location. Defaults to "FRAME".
+            save (bool, optional): Save every cropped stack as .tif in outdir. Defaults to False.
+            nthreads (int, optional): Number of tracks processed at the same time. Defaults to None (ImageJ's thread setting).
         """
 
         imp = self.imp
@@ -78,36 +79,18 @@ class CropTool(object):
         if ntracks == None: ntracks = len(spots)
         elif ntracks > len(spots): ntracks = len(spots)
 
-        def _cropSingleTrack(ispots):
+        def _cropSingleTrack(track, title):
             """Nested function to crop the spots of a single TRACK_ID.
 
             Args:
-                ispots (list): List of getresults() dictionaries belonging to a single track.
+                track (array): The packed ROI positions of a single track, see spotpositions().
+                title (str): Title of the output stack.
 
             Returns:
-                list: A list of ImagePlus stacks of the cropped timeframes.
-            """        
-            outstacks = []
-
-            for j in ispots:
-
-                # Extract all needed row values.
-                j_id = int(j[trackid])
-                j_x = int(j[trackxlocation] * xScaleMultiplier)
-                j_y = int(j[trackylocation] * yScaleMultiplier)
-                j_t = int(j[tracktlocation])
-
-                # Now set an ROI according to the track's xy position in the hyperstack.
-                imp.setRoi(j_x, j_y, roi_x, roi_y)  # upper left x, upper left y, roi x dimension, roi y dimension
-
-                # Optionally, set the correct time position in the stack. This provides cool feedback but is sloooow!
-                # imp.setPosition(1, 1, j_t)
-
-                # Crop the ROI on the corresponding timepoint and add to output stack.
-                crop = Duplicator().run(imp, 1, dims[2], 1, dims[3], j_t, j_t)  # firstC, lastC, firstZ, lastZ, firstT, lastT
-                outstacks.append(crop)
-            
-            return outstacks
+                ImagePlus: A stack of the cropped timeframes.
+            """
+            # Crop the ROI on the corresponding timepoints into one output stack. ROIs crossing the border are padded with zeros.
+            return cropframes(imp, unpackpositions(track), roi_x, roi_y, title)
 
 
         # START OF MAIN FUNCTION.
@@ -128,42 +111,34 @@ class CropTool(object):
             IJ.log("Image is not spatially calibrated. Make sure the input .csv isn't either!")
             IJ.log("Physical units to pixel scale: x = {}, y = {} pixels/unit\n".format(xScaleMultiplier, yScaleMultiplier))
 
-        # Add a black frame around the stack to ensure the cropped roi's are never out of view.
-        expand_x = dims[0] + roi_x
-        expand_y = dims[1] + roi_y
-        # This line could be replaced by ij.plugin.CanvasResizer(). 
-        # However, since that function takes ImageStacks, not ImagePlus, that just makes it more difficult for now.
-        IJ.run(imp, "Canvas Size...", "width={} height={} position=Center zero".format(expand_x, expand_y))
-
-        # Retrieve all unique track ids. This is what we loop through.
-        track_ids = set([ track[trackid] for track in spots ])
-        track_ids = list(track_ids)
-
-        stacks = []
-        # This loop loops through the unique set of TRACK_IDs from the results table.
-        for i in track_ids[0:ntracks]:
-            
-            # Extract all spots (rows) with TRACK_ID == i.
-            trackspots = [ spot for spot in spots if spot[trackid] == i ]
-            # IJ.log ("TRACK_ID: {}/{}".format(int(i+1), len(track_ids))) # Monitor progress
-
-            # Crop the spot locations of the current TRACK_ID.
-            out = _cropSingleTrack(trackspots)
-
-            # Concatenate the frames into one ImagePlus and save.
-            impout = Concatenator().run(out)
-            stacks.append(impout)
-            # outfile = os.path.join(outdir, "TRACK_ID_{}.tif".format(int(i)))
-            # IJ.saveAs(out, "Tiff", outfile)
-
-        self.croppedpoints = stacks
+        # Collect the ROI positions of all spots per track in a single pass, centered on the spot's xy position in
+        # the hyperstack. The unique track ids are what we loop through.
+        index = spotpositions(spots, roi_x, roi_y, xScaleMultiplier, yScaleMultiplier, 0,
+                              trackid, trackxlocation, trackylocation, tracktlocation)
+        track_ids = sorted(index)
+
+        def _processTrack(i):
+            # Crop the spot locations (rows with TRACK_ID == i) of a single track, and optionally save them.
+            impout = _cropSingleTrack(index[i], "TRACK_ID_{}".format(int(i)))
+            if save and impout is not None:
+                saveimage(impout, outdir, writer)
+            return impout
+
+        # The tracks only read from the source stack, so the unique set of TRACK_IDs can be processed in parallel
+        # (virtual stacks are read by a single thread). The stacks are saved in the background; a failed write is
+        # raised as IOError when the writer is closed.
+        with usewriter() as writer:
+            stacks = parallelmap(_processTrack, track_ids[0:ntracks], readthreads(imp.getStack(), nthreads))
+
+        # Tracks without frames within the image are skipped.
+        self.croppedpoints = [impout for impout in stacks if impout is not None]
         IJ.log("\nExecution croppoints() finished.")
 
 
     def croptracks(self, outdir, trackid="TRACK_ID",
             trackx="TRACK_X_LOCATION", tracky="TRACK_Y_LOCATION",
             trackstart="TRACK_START", trackstop="TRACK_STOP",
-            roi_x=150, roi_y=150):
+            roi_x=150, roi_y=150, save=False, nthreads=None):
         """Function cropping ROIs from an ImagePlus stack based on a ResultsTable object.
 
         This function crops square ROIs from a hyperstack based on locations defined in the ResultsTable.
@@ -171,6 +146,8 @@ class CropTool(object):
 
         "TRACK_ID", "TRACK_X_LOCATION", "TRACK_Y_LOCATION", "TRACK_START", "TRACK_STOP"
 
+        Tracks are cropped (and optionally saved) in parallel. The cropped stacks are stored in track order.
+
         Args:
             imp: An ImagePlus hyperstack (timelapse).
             tracks: A getresults(ResultsTable) object (from Track statistics.csv) with the proper column names.
@@ -182,6 +159,8 @@ class CropTool(object):
             trackstop: Defaults to "TRACK_STOP".
             roi_x: Width of the ROI.
             roi_y: Height of the ROI.
+            save: Save every cropped stack as .tif in outdir. Defaults to False.
+            nthreads: Number of tracks processed at the same time. Defaults to None (ImageJ's thread setting).
         """
 
         imp = self.imp
@@ -189,34 +168,38 @@ class CropTool(object):
 
         cal = imp.getCalibration()
 
-        stacks = []
-        # Loop through all the tracks, extract the track position, set an ROI and crop the hyperstack.
-        for i in tracks:  # This loops through all tracks. Use a custom 'tracks[0:5]' to test and save time!
+        # Retrieve image dimensions.
+        width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+
+        # Read the needed columns at once.
+        ids, xs, ys, starts, stops = getcolumns(tracks, (trackid, trackx, tracky, trackstart, trackstop))
 
+        def _processTrack(row):
             # Extract all needed row values.
-            i_id = int(i[trackid])
-            i_x = int(i[trackx] / cal.pixelWidth) # TODO fix for calibration.
-            i_y = int(i[tracky] / cal.pixelHeight) # TODO fix for calibration.
-            i_start = int(i[trackstart] / cal.frameInterval)
-            i_stop = int(i[trackstop] / cal.frameInterval)
-
-            # Now set an ROI according to the track's xy position in the hyperstack.
-            imp.setRoi(i_x - roi_x / 2, i_y - roi_y / 2,  # upper left x, upper left y
-                    roi_x, roi_y)  # roi x dimension, roi y dimension
-
-            # Retrieve image dimensions.
-            width, height, nChannels, nSlices, nFrames = imp.getDimensions()
-
-            # And then crop (duplicate, actually) this ROI for the track's time duration.
-            # IJ.log("Cropping image with TRACK_ID: {}/{}".format(i_id+1, int(len(tracks))))
-            # Duplicator().run(firstC, lastC, firstZ, lastZ, firstT, lastT)
-            impout = Duplicator().run(imp, 1, nChannels, 1, nSlices, i_start, i_stop)  
-            stacks.append(impout)
+            i_id = int(ids[row])
+            i_x = int(xs[row] / cal.pixelWidth) # TODO fix for calibration.
+            i_y = int(ys[row] / cal.pixelHeight) # TODO fix for calibration.
+            i_start = int(starts[row] / cal.frameInterval)
+            i_stop = int(stops[row] / cal.frameInterval)
+
+            # Crop a ROI centered on the track's xy position for the track's time duration. The source image
+            # itself is not touched (no setRoi), so tracks can be cropped at the same time.
+            positions = [(t, i_x - roi_x // 2, i_y - roi_y // 2)  # frame, upper left x, upper left y
+                         for t in range(max(i_start, 1), min(i_stop, nFrames) + 1)]
+            impout = cropframes(imp, positions, roi_x, roi_y, "TRACK_ID_{}".format(i_id))
+
             # Save the substack in the output directory
-            # outfile = os.path.join(outdir, "TRACK_ID_{}.tif".format(i_id))
-            # IJ.saveAs(imp2, "Tiff", outfile)
+            if save and impout is not None:
+                saveimage(impout, outdir, writer)
+            return impout
+
+        # Loop through all the tracks in parallel (virtual stacks are read by a single thread), saving in the
+        # background. Use a custom 'tracks[0:5]' to test and save time!
+        with usewriter() as writer:
+            stacks = parallelmap(_processTrack, range(len(ids)), readthreads(imp.getStack(), nthreads))
 
-        self.croppedtracks = stacks
+        # Tracks without frames within the image are skipped.
+        self.croppedtracks = [impout for impout in stacks if impout is not None]
         IJ.log("\nExecution croptracks() finished.")
 
 
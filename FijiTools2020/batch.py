@@ -0,0 +1,151 @@
+# Jorik van Rijn <jorik.vanrijn@gmail.com> - 2020
+import os
+import sys
+import glob
+import argparse
+import subprocess
+import ij.IJ as IJ
+from java.lang import System
+from FijiTools2020.fileHandling import parallelmap, BackgroundCache
+from FijiTools2020.pipelines import PIPELINES, outputpath, runpipeline
+
+# The input file extensions picked up from a directory.
+INPUT_EXTENSIONS = (".ome.tif", ".ome.tiff")
+
+
+def findinputs(pattern):
+    """List the input images of a batch.
+
+    Args:
+        pattern (str): An input directory, which is searched recursively
+            for .ome.tif files, or a glob pattern like "/data/*.tif".
+
+    Returns:
+        list: The sorted input paths.
+    """
+    if os.path.isdir(pattern):
+        inputs = []
+        for root, dirs, files in os.walk(pattern):
+            for name in files:
+                if name.lower().endswith(INPUT_EXTENSIONS):
+                    inputs.append(os.path.join(root, name))
+        return sorted(inputs)
+    return sorted(glob.glob(pattern))
+
+
+def _workerscript():
+    # The path of this module as source file, to run it in the workers.
+    path = os.path.abspath(__file__)
+    if path.endswith("$py.class"):
+        path = path[:-len("$py.class")] + ".py"
+    return path
+
+
+def batchrun(pattern, outdir, pipeline, nworkers=2, memory="4g", fiji=None, cachedir=None):
+    """Run a pipeline headless on every input image.
+
+    Every image is processed by its own Fiji process, so each worker
+has its own memory limit and a failing image does not stop the batch.
+Images whose output already exists in outdir are skipped, so an
+interrupted batch can simply be started again.
+
+    Args:
+        pattern (str): An input directory or glob pattern, see findinputs().
+        outdir (path): The output directory.
+        pipeline (str): A pipeline name in pipelines.PIPELINES.
+        nworkers (int, optional): The number of images processed at the
+            same time. Defaults to 2.
+        memory (str, optional): The maximum memory of every worker, like
+            "4g" or "512m". Defaults to "4g".
+        fiji (path, optional): The Fiji launcher. Defaults to None (the
+            launcher of the running Fiji).
+        cachedir (path, optional): The BackgroundCache directory the
+            workers share. Defaults to None (the default cache directory).
+
+    Returns:
+        list: The input paths that failed.
+    """
+    if pipeline not in PIPELINES:
+        raise ValueError("Unknown pipeline {}, choose from {}".format(
+            pipeline, ", ".join(sorted(PIPELINES))))
+    if fiji is None:
+        fiji = System.getProperty("ij.executable")
+    if not fiji:
+        raise ValueError("Could not find the Fiji launcher, please pass fiji")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    inputs = findinputs(pattern)
+    todo = [i for i in inputs if not os.path.exists(outputpath(i, outdir))]
+    IJ.log("Batch {}: {} images, {} already done.".format(
+        pipeline, len(inputs), len(inputs) - len(todo)))
+
+    def _run(inpath):
+        command = [fiji, "--mem={}".format(memory), "--headless", "--jython",
+                   _workerscript(), "worker", pipeline, inpath, outdir]
+        if cachedir is not None:
+            command += ["--cache", cachedir]
+        returncode = subprocess.call(command)
+        if returncode == 0:
+            IJ.log("Finished {}".format(os.path.basename(inpath)))
+        else:
+            IJ.log("Failed {} (exit code {})".format(os.path.basename(inpath), returncode))
+        return returncode
+
+    returncodes = parallelmap(_run, todo, nworkers)
+    failed = [i for i, code in zip(todo, returncodes) if code != 0]
+    IJ.log("\nExecution batchrun() finished, {} failed.".format(len(failed)))
+    return failed
+
+
+def main(args):
+    """The command line entry point. Run a whole batch headless with:
+
+        fiji --headless --jython batch.py run PATTERN OUTDIR PIPELINE [--workers N] [--memory 4g] [--cache DIR]
+
+    batchrun() starts its workers with the worker command:
+
+        fiji --headless --jython batch.py worker PIPELINE INPATH OUTDIR [--cache DIR]
+
+    Workers cache the backgrounds they compute, so running a batch again
+on the same files skips computing them.
+
+    Args:
+        args (list): The command line arguments, without the script name.
+    """
+    parser = argparse.ArgumentParser(
+        prog="batch.py", description="Run a Flexoscope pipeline on a batch of images.")
+    commands = parser.add_subparsers(dest="command")
+
+    run = commands.add_parser("run", help="process every input image")
+    run.add_argument("pattern", help="input directory or glob pattern")
+    run.add_argument("outdir", help="output directory")
+    run.add_argument("pipeline", choices=sorted(PIPELINES))
+    run.add_argument("--workers", type=int, default=2, help="images processed at the same time")
+    run.add_argument("--memory", default="4g", help="maximum memory of every worker")
+    run.add_argument("--fiji", default=None, help="the Fiji launcher")
+    run.add_argument("--cache", default=None, help="the background cache directory")
+
+    worker = commands.add_parser("worker", help="process a single image")
+    worker.add_argument("pipeline", choices=sorted(PIPELINES))
+    worker.add_argument("inpath")
+    worker.add_argument("outdir")
+    worker.add_argument("--cache", default=None, help="the background cache directory")
+
+    options = parser.parse_args(args)
+    if options.command == "run":
+        failed = batchrun(options.pattern, options.outdir, options.pipeline,
+                          options.workers, options.memory, options.fiji, options.cache)
+        sys.exit(1 if failed else 0)
+
+    try:
+        runpipeline(options.pipeline, options.inpath, options.outdir,
+                    BackgroundCache(options.cache))
+    except Exception as ex:
+        IJ.log("Something in runpipeline() went wrong: {}".format(type(ex).__name__, ex.args))
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
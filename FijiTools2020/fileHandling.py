@@ -1,7 +1,23 @@
 # Jorik van Rijn <jorik.vanrijn@gmail.com> - 2020
 import ij.IJ as IJ
+import ij.Prefs as Prefs
 import ij.measure.ResultsTable as ResultsTable
+import ij.io.FileSaver as FileSaver
+import ij.io.Opener as Opener
 import os
+import Queue
+import threading
+import csv
+import json
+import hashlib
+from array import array
+from jarray import zeros
+from java.io import FileOutputStream, RandomAccessFile
+from java.lang import Error, String, Throwable
+from java.nio import ByteBuffer
+from java.nio.channels import FileChannel
+from java.util.concurrent import Callable, ExecutionException, Executors
+from org.python.core import PyException
 
 
 def opencsv():
@@ -27,32 +43,162 @@ def opencsv():
             type(ex).__name__, ex.args))
 
 
+def openvirtual(path=None):
+    """Open an image as virtual stack, so planes are only read from disk
+    when they are needed. TIFF files are opened with ImageJ's own
+    virtual stack reader, other formats with a Bio-Formats virtual
+    stack. Ask the user for the location of the image if no path is
+    given.
+
+    Args:
+        path (str, optional): Path to the image file. Defaults to None.
+
+    Returns:
+        ImagePlus: The virtual hyperstack.
+    """
+    if path is None:
+        path = IJ.getFilePath("Choose an image file")
+
+    if path.lower().endswith((".tif", ".tiff")) and \
+            not path.lower().endswith((".ome.tif", ".ome.tiff")):
+        return IJ.openVirtual(path)
+
+    # Bio-Formats ships with Fiji, but is only needed here.
+    from loci.plugins import BF
+    from loci.plugins.in import ImporterOptions
+    options = ImporterOptions()
+    options.setId(path)
+    options.setVirtual(True)
+    return BF.openImagePlus(options)[0]
+
+
+class ResultsColumns(object):
+    """Columnar, read-only representation of a ResultsTable.
+
+    Every numeric column is stored once as a typed array of doubles
+    instead of as one dictionary per row. Indexing or iterating the
+    table yields lightweight row views which behave like the row
+    dictionaries getresults() used to return, so existing code like
+    'row["TRACK_ID"]' keeps working. Use column() to read a whole column
+    at once.
+
+    Args:
+        headings (list): The column names, in table order.
+        columns (dict): Column names as keys and array('d') objects of
+            equal length as values.
+        labels (list, optional): String values of the label column.
+            Defaults to None.
+        labelheading (str, optional): Column name of the label column.
+            Defaults to "Label".
+    """
+    __slots__ = ("headings", "columns", "labels", "labelheading", "size")
+
+    def __init__(self, headings, columns, labels=None, labelheading="Label"):
+        self.headings = list(headings)
+        self.columns = columns
+        self.labels = labels
+        self.labelheading = labelheading
+        if labels is not None and labelheading not in self.headings:
+            self.headings.append(labelheading)
+        if columns:
+            self.size = len(next(iter(columns.values())))
+        elif labels is not None:
+            self.size = len(labels)
+        else:
+            self.size = 0
+
+    def column(self, name):
+        """Return a complete column.
+
+        Args:
+            name (str): The column name.
+
+        Returns:
+            array or list: The column values.
+        """
+        if name == self.labelheading and self.labels is not None:
+            return self.labels
+        return self.columns[name]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_ResultsRow(self, i)
+                    for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("row index out of range")
+        return _ResultsRow(self, index)
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield _ResultsRow(self, i)
+
+
+class _ResultsRow(object):
+    """Dictionary-like view of a single ResultsColumns row."""
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, column):
+        return self.table.column(column)[self.row]
+
+    def __contains__(self, column):
+        return column in self.table.headings
+
+    def __iter__(self):
+        return iter(self.table.headings)
+
+    def __len__(self):
+        return len(self.table.headings)
+
+    def get(self, column, default=None):
+        if column in self.table.headings:
+            return self[column]
+        return default
+
+    def keys(self):
+        return list(self.table.headings)
+
+    def items(self):
+        return [(column, self[column]) for column in self.table.headings]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 def getresults(rt):
-    """Retrieve IJ ResultsTable object and return table as list of
-    dictionaries.
+    """Retrieve IJ ResultsTable object and return it as a columnar
+    ResultsColumns table.
 
-    This makes it much easier to iterate through the rows of a
-    ResultsTable object from within ImageJ.
+    Each column is read from the ResultsTable in one bulk call and
+    stored as a typed array. Rows can still be iterated and indexed as
+    dictionaries with column names as keys, so the table can be used
+    like the list of dictionaries this function used to return.
 
     Args: rt (ij.measure.ResultsTable): An Imagej ResultsTable object.
 
-    Returns: list: A list of ResultsTable rows, represented as
-        dictionary with column names as keys.
+    Returns: ResultsColumns: The table, with column names as keys.
 
         for example:
-            [
-            {'column1' : 'value', 'column2' : 'value', ...},
-            {'column1' : 'value', 'column2' : 'value', ...},
-            ...,
-            ]
+            table[0]['column1'] -> value
+            table.column('column1') -> array('d', [value, value, ...])
     """
     try:
-        columns = rt.getHeadings()
-        table = [{column: rt.getValue(column, row)
-                  for column in columns} for row in range(rt.size())]
+        headings = [h for h in rt.getHeadings() if h != "Label"]
+        columns = dict((heading, array("d", rt.getColumn(heading)))
+                       for heading in headings)
+        labels = None
         if rt.columnExists("Label"):
-            for i in range(len(table)):
-                table[i]["Label"] = rt.getStringValue("Label", i)
+            labels = [rt.getStringValue("Label", i)
+                      for i in range(rt.size())]
+        table = ResultsColumns(headings, columns, labels)
         # IJ.log("table: {}\nlength: {}".format(table, len(table)))
         return table
     except AttributeError:
@@ -62,6 +208,472 @@ def getresults(rt):
             type(ex).__name__, ex.args))
 
 
+def getcolumns(table, names):
+    """Read whole columns of a table at once.
+
+    Args:
+        table (ResultsColumns): A getresults() or loadcsv() table, or
+            any list of row dictionaries.
+        names (list): The column names.
+
+    Returns:
+        list: One array (or list) of values for every name.
+    """
+    if isinstance(table, ResultsColumns):
+        return [table.column(name) for name in names]
+    return [[row[name] for row in table] for name in names]
+
+
+def tablechunks(table, chunksize=65536):
+    """Iterate over a table in chunks.
+
+    Args:
+        table: A ResultsColumns table, a list of row dictionaries, or an
+            iterable of ResultsColumns chunks like readcsv(path, columns,
+            chunksize) or of row dictionaries like readcsv(path,
+            columns), which are consumed lazily.
+        chunksize (int, optional): The number of rows per chunk when
+            table is an iterable of row dictionaries. Defaults to 65536.
+
+    Returns:
+        iterable: The ResultsColumns chunks or lists of rows.
+    """
+    if isinstance(table, ResultsColumns):
+        return [table]
+    if isinstance(table, list) and not all(isinstance(chunk, ResultsColumns) for chunk in table):
+        return [table]
+    if isinstance(table, list):
+        return table
+    return _iterchunks(table, chunksize)
+
+
+def _iterchunks(items, chunksize):
+    # Pass ResultsColumns chunks on, and group single rows into lists.
+    rows = []
+    for item in items:
+        if isinstance(item, ResultsColumns):
+            if rows:
+                yield rows
+                rows = []
+            yield item
+        elif isinstance(item, dict):
+            rows.append(item)
+            if len(rows) >= chunksize:
+                yield rows
+                rows = []
+        else:
+            raise TypeError("tablechunks() expects ResultsColumns chunks or row dictionaries, not {}.".format(
+                type(item).__name__))
+    if rows:
+        yield rows
+
+
+# Columns needed by the cropping functions, for use as a projection in
+# readcsv() and loadcsv().
+SPOT_COLUMNS = ("TRACK_ID", "POSITION_X", "POSITION_Y", "FRAME")
+TRACK_COLUMNS = ("TRACK_ID", "TRACK_X_LOCATION", "TRACK_Y_LOCATION",
+                 "TRACK_START", "TRACK_STOP")
+LABEL_COLUMNS = ("Label", "LABEL")
+
+
+def readcsv(path, columns=None, chunksize=None, cache=False):
+    """Stream the rows of a (TrackMate) .csv file without loading it
+    into a ResultsTable.
+
+    The first row holds the column names. TrackMate 7 exports add three
+    more header rows (feature names, short names and units); these and
+    any other non-numeric rows before the first data row are skipped.
+    Label columns are kept as strings, all other values are read as
+    floats (NaN when a cell is empty or not a number).
+
+    Args:
+        path (str): Path to the .csv file.
+        columns (list, optional): Column names to read. Defaults to None
+            (all columns).
+        chunksize (int, optional): If set, yield ResultsColumns tables of
+            at most this many rows instead of single rows. Defaults to None.
+        cache (bool, optional): With chunksize, read the binary sidecar
+            of the .csv instead if it is valid, and yield it as a single
+            chunk (see readcache()). Otherwise the chunks are parsed and,
+            once all are read, written to the sidecar for the next run.
+            Defaults to False.
+
+    Yields:
+        dict or ResultsColumns: A row dictionary with column names as
+            keys, or a chunk of rows as ResultsColumns table.
+    """
+    if cache and chunksize is not None:
+        table = readcache(path, columns)
+        if table is not None:
+            IJ.log("Read {} rows from cache of {}.".format(
+                len(table), os.path.basename(path)))
+            yield table
+            return
+        # Keep the chunks for the sidecar; only the requested columns
+        # are parsed, so they are small next to the .csv.
+        parsed = []
+        for chunk in readcsv(path, columns, chunksize):
+            parsed.append(chunk)
+            yield chunk
+        writecache(path, _concatchunks(parsed, columns), complete=columns is None)
+        return
+
+    nan = float("nan")
+
+    with open(path, "rb") as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader)]
+
+        # Project on the requested columns.
+        if columns is None:
+            columns = [h for h in header if h]
+        missing = [c for c in columns if c not in header]
+        if missing:
+            raise KeyError("Columns not found in {}: {}".format(
+                os.path.basename(path), ", ".join(missing)))
+        positions = [header.index(c) for c in columns]
+        labelheading = None
+        for c in columns:
+            if c in LABEL_COLUMNS:
+                labelheading = c
+        numeric = [(c, p) for c, p in zip(columns, positions)
+                   if c != labelheading]
+        labelpos = header.index(labelheading) if labelheading else None
+
+        def _parse(line):
+            values = {}
+            for c, p in numeric:
+                try:
+                    values[c] = float(line[p])
+                except (ValueError, IndexError):
+                    values[c] = nan
+            if labelpos is not None:
+                values[labelheading] = line[labelpos] if labelpos < len(line) else ""
+            return values
+
+        def _isdata(line):
+            # Header rows hold text (names or units), data rows hold
+            # numbers or empty cells.
+            found = False
+            for c, p in numeric:
+                if p >= len(line) or not line[p].strip():
+                    continue
+                try:
+                    float(line[p])
+                    found = True
+                except ValueError:
+                    return False
+            return found
+
+        def _rows():
+            indata = False
+            for line in reader:
+                if not line:
+                    continue
+                if not indata:
+                    # Skip the extra header rows of TrackMate 7 exports.
+                    if not _isdata(line):
+                        continue
+                    indata = True
+                yield _parse(line)
+
+        if chunksize is None:
+            for row in _rows():
+                yield row
+            return
+
+        def _newchunk():
+            return dict((c, array("d")) for c, p in numeric), []
+
+        data, labels = _newchunk()
+        n = 0
+        for row in _rows():
+            for c, p in numeric:
+                data[c].append(row[c])
+            if labelheading:
+                labels.append(row[labelheading])
+            n += 1
+            if n == chunksize:
+                yield ResultsColumns([c for c, p in numeric], data,
+                                     labels if labelheading else None,
+                                     labelheading or "Label")
+                data, labels = _newchunk()
+                n = 0
+        if n:
+            yield ResultsColumns([c for c, p in numeric], data,
+                                 labels if labelheading else None,
+                                 labelheading or "Label")
+
+
+def _concatchunks(chunks, columns=None):
+    # Join readcsv() chunks into a new ResultsColumns table, leaving the
+    # chunks as they are.
+    table = None
+    for chunk in chunks:
+        if table is None:
+            table = ResultsColumns(
+                [h for h in chunk.headings if h in chunk.columns],
+                dict((h, array("d", values)) for h, values in chunk.columns.items()),
+                list(chunk.labels) if chunk.labels is not None else None,
+                chunk.labelheading)
+            continue
+        for heading in table.columns:
+            table.columns[heading].extend(chunk.columns[heading])
+        if table.labels is not None:
+            table.labels.extend(chunk.labels)
+        table.size += chunk.size
+
+    if table is None:
+        # Header only, no data rows.
+        numeric = [c for c in columns or [] if c not in LABEL_COLUMNS]
+        table = ResultsColumns(numeric, dict(
+            (c, array("d")) for c in numeric))
+    return table
+
+
+def loadcsv(path=None, columns=None, chunksize=65536, cache=True):
+    """Read a (TrackMate) .csv file into a ResultsColumns table with
+    readcsv(). Only the requested columns are kept in memory. Asks the
+    user for the location of the .csv file if no path is given.
+
+    With cache enabled, the parsed table is also written to a binary
+    sidecar file next to the .csv (see readcache()). Later calls load
+    the sidecar instead of parsing the .csv again, as long as the .csv
+    was not changed.
+
+    Args:
+        path (str, optional): Path to the .csv file. Defaults to None.
+        columns (list, optional): Column names to read, e.g.
+            SPOT_COLUMNS. Defaults to None (all columns).
+        chunksize (int, optional): Number of rows parsed per chunk.
+            Defaults to 65536.
+        cache (bool, optional): Read and write the binary sidecar.
+            Defaults to True.
+
+    Returns:
+        ResultsColumns: The table, with column names as keys.
+    """
+    if path is None:
+        path = IJ.getFilePath("Choose a .csv file")
+
+    try:
+        if not path.endswith(".csv"):
+            raise TypeError()
+
+        if cache:
+            table = readcache(path, columns)
+            if table is not None:
+                IJ.log("Read {} rows from cache of {}.".format(
+                    len(table), os.path.basename(path)))
+                return table
+
+        table = _concatchunks(readcsv(path, columns, chunksize), columns)
+        if cache:
+            writecache(path, table, complete=columns is None)
+        return table
+    except TypeError:
+        IJ.log("The chosen file was not a .csv file.")
+    except Exception as ex:
+        IJ.log("Something in loadcsv() went wrong: {}".format(
+            type(ex).__name__, ex.args))
+
+
+# Version tag of the binary sidecar format written by writecache().
+CACHE_MAGIC = "FijiTools2020-columns-1"
+
+
+def cachepath(path):
+    """Return the path of the binary sidecar belonging to a .csv file.
+
+    Args:
+        path (str): Path to the .csv file.
+
+    Returns:
+        str: Path to the sidecar file.
+    """
+    return "{}.cache".format(path)
+
+
+def _cachekey(path):
+    """Identify the current state of a file by path, size and mtime."""
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size,
+            "mtime": stat.st_mtime}
+
+
+def writecache(path, table, complete=False):
+    """Write a ResultsColumns table to the binary sidecar of a .csv file.
+
+    The sidecar holds a one-line JSON header with the cache key (path,
+    size and mtime of the .csv), followed by every column as big-endian
+    doubles and finally the labels, if any, as newline separated UTF-8.
+    Failing to write the sidecar is logged, but not raised.
+
+    Args:
+        path (str): Path to the .csv file the table was read from.
+        table (ResultsColumns): The parsed table.
+        complete (bool, optional): Whether the table holds all columns
+            of the .csv file. Defaults to False.
+    """
+    numeric = [h for h in table.headings if h in table.columns]
+    labels = None
+    if table.labels is not None:
+        labels = String(u"\n".join(table.labels)).getBytes("UTF-8")
+
+    header = _cachekey(path)
+    header.update({"magic": CACHE_MAGIC, "rows": len(table),
+                   "columns": numeric, "complete": complete,
+                   "labelheading": table.labelheading if labels is not None else None,
+                   "labelbytes": len(labels) if labels is not None else 0})
+
+    sidecar = cachepath(path)
+    tmp = sidecar + ".tmp"
+    try:
+        out = FileOutputStream(tmp)
+        try:
+            out.write(String(json.dumps(header) + "\n").getBytes("UTF-8"))
+            for heading in numeric:
+                buf = ByteBuffer.allocate(8 * len(table))
+                buf.asDoubleBuffer().put(table.columns[heading])
+                out.write(buf.array())
+            if labels is not None:
+                out.write(labels)
+        finally:
+            out.close()
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        os.rename(tmp, sidecar)
+    except Exception as ex:
+        IJ.log("Could not write cache {}: {}".format(sidecar, ex))
+
+
+def readcache(path, columns=None):
+    """Load a ResultsColumns table from the binary sidecar of a .csv
+    file, by memory-mapping the column data.
+
+    Args:
+        path (str): Path to the .csv file.
+        columns (list, optional): Column names that must be present.
+            Defaults to None (all columns of the .csv file).
+
+    Returns:
+        ResultsColumns: The table, or None if there is no valid sidecar
+            for the current version of the .csv file.
+    """
+    sidecar = cachepath(path)
+    if not os.path.exists(sidecar):
+        return None
+
+    try:
+        with open(sidecar, "rb") as f:
+            header = json.loads(f.readline())
+            offset = f.tell()
+
+        # Invalidate the sidecar when the .csv changed.
+        key = _cachekey(path)
+        if header.get("magic") != CACHE_MAGIC or any(
+                header.get(k) != v for k, v in key.items()):
+            return None
+
+        labelheading = header["labelheading"]
+        available = header["columns"] + ([labelheading] if labelheading else [])
+        if columns is None:
+            if not header["complete"]:
+                return None
+            columns = available
+        elif any(c not in available for c in columns):
+            return None
+
+        n = header["rows"]
+        raf = RandomAccessFile(sidecar, "r")
+        try:
+            channel = raf.getChannel()
+            mapped = channel.map(FileChannel.MapMode.READ_ONLY, offset,
+                                 channel.size() - offset)
+            doubles = mapped.asDoubleBuffer()
+            data = {}
+            for i, heading in enumerate(header["columns"]):
+                if heading in columns:
+                    values = zeros(n, "d")
+                    doubles.position(i * n)
+                    doubles.get(values)
+                    data[heading] = values
+            labels = None
+            if labelheading and labelheading in columns:
+                raw = zeros(header["labelbytes"], "b")
+                mapped.position(8 * n * len(header["columns"]))
+                mapped.get(raw)
+                labels = String(raw, "UTF-8").split("\n", -1) if n else []
+                labels = list(labels)
+        finally:
+            raf.close()
+
+        headings = [c for c in header["columns"] if c in data]
+        return ResultsColumns(headings, data, labels, labelheading or "Label")
+    except Exception as ex:
+        IJ.log("Could not read cache {}: {}".format(sidecar, ex))
+        return None
+
+
+def spotpositions(spots, roi_x=150, roi_y=150, xscale=1, yscale=1, frameoffset=1,
+                  trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y",
+                  tracktlocation="FRAME"):
+    """Collect the ROI positions of the spots of every track.
+
+    The table is read chunk by chunk, straight from the columns, and only
+    the positions are kept, packed in one integer array per track. A
+    spots table that does not fit in memory can so be streamed from
+    readcsv(). Use unpackpositions() to get the positions of a track.
+
+    Args:
+        spots: A getresults() or loadcsv() table, or the chunks or rows of readcsv().
+        roi_x (int, optional): ROI width (pixels). Defaults to 150.
+        roi_y (int, optional): ROI height (pixels). Defaults to 150.
+        xscale (float, optional): Pixels per x unit. Defaults to 1.
+        yscale (float, optional): Pixels per y unit. Defaults to 1.
+        frameoffset (int, optional): Added to the spot frame to get the 1-based frame. Defaults to 1.
+        trackid (str, optional): Column name of Track identifiers. Defaults to "TRACK_ID".
+        trackxlocation (str, optional): Column name of spot x location. Defaults to "POSITION_X".
+        trackylocation (str, optional): Column name of spot y location. Defaults to "POSITION_Y".
+        tracktlocation (str, optional): Column name of spot time location. Defaults to "FRAME".
+
+    Returns:
+        dict: TRACK_ID as keys, and array("i") of packed (frame, upper
+            left x, upper left y) values as values. Spots without a
+            valid track identifier (NaN) are skipped.
+    """
+    packed = {}
+    for chunk in tablechunks(spots):
+        ids, xs, ys, ts = getcolumns(
+            chunk, (trackid, trackxlocation, trackylocation, tracktlocation))
+        for j in range(len(ids)):
+            key = ids[j]
+            if key != key:  # NaN
+                continue
+            try:
+                track = packed[key]
+            except KeyError:
+                track = packed[key] = array("i")
+            # The ROI is centered on the spot's xy position in the
+            # hyperstack: frame, upper left x, upper left y.
+            track.extend((int(ts[j] + frameoffset),
+                          int(xs[j] * xscale) - roi_x // 2,
+                          int(ys[j] * yscale) - roi_y // 2))
+    return packed
+
+
+def unpackpositions(track):
+    """Unpack the positions of a track from spotpositions().
+
+    Args:
+        track (array): The packed positions of a single track.
+
+    Returns:
+        list: A list of (frame, upper left x, upper left y) tuples, sorted on frame.
+    """
+    return sorted(zip(track[0::3], track[1::3], track[2::3]))
+
+
 def chunks(seq, num):
     """This function takes a list 'seq' and returns it in more or less
     equal parts of length 'num' as a list of lists.
@@ -83,13 +695,468 @@ def chunks(seq, num):
     return out
 
 
-def saveimage(imp, outdir):
+class _Task(Callable):
+    """Wraps a function call as java.util.concurrent.Callable."""
+
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+
+    def call(self):
+        return self.func(self.item)
+
+
+def parallelmap(func, items, nthreads=None):
+    """Apply a function to every item on a pool of threads.
+
+    The results are returned in the order of the input items, regardless
+    of the order in which the threads finish. The first exception raised
+    by any of the calls is raised again here: Python exceptions with
+    their original type and traceback, Java throwables as they are.
+
+    Args:
+        func (function): A function taking a single item.
+        items (list): The items to process.
+        nthreads (int, optional): The number of worker threads. Defaults to
+            None (the number of threads set in Edit > Options > Memory & Threads).
+
+    Returns:
+        list: The return values of func, in the order of the items.
+    """
+    items = list(items)
+    if nthreads is None:
+        nthreads = Prefs.getThreads()
+    nthreads = min(nthreads, len(items))
+    if nthreads <= 1:
+        return [func(item) for item in items]
+
+    pool = Executors.newFixedThreadPool(nthreads)
+    try:
+        futures = pool.invokeAll([_Task(func, item) for item in items])
+        results = []
+        for future in futures:
+            try:
+                results.append(future.get())
+            except ExecutionException as ex:
+                # Python exceptions reach the pool wrapped in a PyException;
+                # raise the original one, with the traceback of the worker.
+                cause = ex.getCause()
+                if isinstance(cause, PyException):
+                    raise cause.type, cause.value, cause.traceback
+                raise cause
+        return results
+    finally:
+        pool.shutdown()
+
+
+def readthreads(stack, nthreads=None):
+    """The number of threads that may read planes from a stack at the
+    same time. Virtual stacks (and Bio-Formats readers behind them) are
+    not safe to read from several threads, so they are read by one.
+
+    Args:
+        stack (ImageStack): The stack to read from.
+        nthreads (int, optional): The wanted number of threads. Defaults to
+            None (the number of threads set in Edit > Options > Memory & Threads).
+
+    Returns:
+        int: The number of threads, or None for ImageJ's thread setting.
+    """
+    if stack.isVirtual():
+        return 1
+    return nthreads
+
+
+class ImageWriter(object):
+    """Saves ImagePlus objects as .tiff on background threads, so that
+    disk writes overlap with the processing of the next image.
+
+    Images are queued with save(). The queue is bounded: when it is full,
+    save() blocks until a writer thread picks up the next image, which
+    keeps the number of images waiting in memory limited. close() waits
+    until all queued images are written and raises an IOError if any of
+    them failed. A Java Error in a writer thread (like an
+    OutOfMemoryError) is raised again as is, and the images still queued
+    are dropped. The writer can also be used as context manager:
+
+        with ImageWriter() as writer:
+            writer.save(imp, outfile)
+
+    Args:
+        maxqueued (int, optional): Maximum number of images waiting to be
+            written. Defaults to 4.
+        nthreads (int, optional): Number of writer threads. Defaults to 1.
+    """
+
+    def __init__(self, maxqueued=4, nthreads=1):
+        self.queue = Queue.Queue(maxqueued)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._write,
+                                         name="ImageWriter-{}".format(i))
+                        for i in range(nthreads)]
+        for thread in self.threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def save(self, imp, path, done=None):
+        """Queue an image to be saved as .tiff. Blocks while the queue is
+        full.
+
+        Args:
+            imp (ImagePlus): An ImagePlus object.
+            path (str): The output file. The extension is replaced by .tif.
+            done (function, optional): Called on the writer thread once
+                the image is saved. Defaults to None.
+
+        Raises:
+            IOError: An earlier queued image could not be saved.
+        """
+        if self.errors:
+            self._raise("Could not save {}".format(self.errors[0][0]))
+        if not self.threads:
+            raise IOError("The ImageWriter was already closed.")
+        self.queue.put((imp, tifpath(path), done))
+
+    def close(self):
+        """Wait until all queued images are written and stop the writer
+        threads.
+
+        Raises:
+            IOError: One or more images could not be saved.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        if self.errors:
+            for path, ex in self.errors:
+                IJ.log("Could not save {}: {}".format(path, ex))
+            self._raise("Could not save {} image(s).".format(
+                len(self.errors)))
+
+    def _raise(self, message):
+        # A Java Error (like an OutOfMemoryError) is raised again as is,
+        # other failures as IOError.
+        for path, ex in self.errors:
+            if isinstance(ex, Error):
+                raise ex
+        raise IOError(message)
+
+    def _write(self):
+        fatal = False
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if fatal:
+                # Drain the queue, so save() and close() never block on
+                # a writer that stopped writing.
+                continue
+            imp, path, done = item
+            try:
+                if not FileSaver(imp).saveAsTiff(path):
+                    raise IOError("FileSaver failed")
+                if done is not None:
+                    done()
+            except (Exception, Throwable) as ex:
+                self.errors.append((path, ex))
+                fatal = isinstance(ex, Error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original exception behind a write error.
+            try:
+                self.close()
+            except IOError:
+                pass
+        return False
+
+
+class _SharedWriter(object):
+    """Context manager handing out an ImageWriter that is closed by its
+    owner, not at the end of the with block."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __enter__(self):
+        return self.writer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def usewriter(writer=None):
+    """Use an existing ImageWriter, or a new one for the duration of a
+    with block.
+
+    Args:
+        writer (ImageWriter, optional): An ImageWriter shared with the
+            caller, which stays open after the with block. Defaults to
+            None (create a new writer, which is closed after the with block).
+
+    Returns:
+        A context manager returning the ImageWriter.
+    """
+    if writer is None:
+        return ImageWriter()
+    return _SharedWriter(writer)
+
+
+def tifpath(path):
+    """Replace the extension of a path by .tif, like IJ.saveAs() does.
+
+    Args:
+        path (str): A file path.
+
+    Returns:
+        str: The file path ending in .tif.
+    """
+    root, ext = os.path.splitext(path)
+    if ext.lower() in (".tif", ".tiff"):
+        return path
+    return root + ".tif"
+
+
+def saveimage(imp, outdir, writer=None):
     """Saves ImagePlus as .tiff.
 
     Args:
         imp (ImagePlus): An ImagePlus object.
         outdir (dirpath): The output directory.
+        writer (ImageWriter, optional): Queue the image on this writer
+            instead of saving it right away. Defaults to None.
     """
     name = imp.getTitle()
     outfile = os.path.join(outdir, "{}.jpg".format(name))
-    IJ.saveAs(imp, "Tiff", outfile)
+    if writer is not None:
+        writer.save(imp, outfile)
+    else:
+        IJ.saveAs(imp, "Tiff", outfile)
+
+
+def sourcepath(imp):
+    """Return the file an ImagePlus was opened from, if known.
+
+    Args:
+        imp (ImagePlus): An ImagePlus object.
+
+    Returns:
+        str: The file path, or None for images that were not opened from
+            a file (like the output of ChannelSplitter).
+    """
+    fi = imp.getOriginalFileInfo()
+    if fi is None or not fi.fileName:
+        return None
+    path = os.path.join(fi.directory or "", fi.fileName)
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def backgroundkey(source, channel, method, params):
+    """Hash the identity of a computed background.
+
+    Args:
+        source (str): The source image file. Its path, size and mtime
+            are part of the key, so changing the file invalidates it.
+        channel (int): The channel of the source the background was
+            computed from.
+        method (str): The name of the method, like "Median".
+        params (dict): The parameters of the method.
+
+    Returns:
+        str: The hexadecimal key.
+    """
+    identity = [_cachekey(source), channel, method, params]
+    return hashlib.sha1(json.dumps(identity, sort_keys=True)).hexdigest()
+
+
+class BackgroundCache(object):
+    """An on-disk cache of computed backgrounds, like median projections
+    or blurred backgrounds, so repeated runs skip the most expensive step.
+
+    Backgrounds are saved as .tif files named by their backgroundkey(),
+    so a key is all it takes to find a background again. Every hit
+    touches the file; when the cache grows over maxbytes the least
+    recently used backgrounds are removed first. Failing to read or
+    write the cache is logged, but not raised: the background is then
+    simply computed.
+
+    Args:
+        directory (str, optional): The cache directory. Defaults to None
+            (.FijiTools2020/backgrounds in the home directory).
+        maxbytes (int, optional): The maximum size of the cache, or None
+            for no limit. Defaults to 2 GB.
+    """
+
+    def __init__(self, directory=None, maxbytes=2 * 1024 ** 3):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser("~"), ".FijiTools2020", "backgrounds")
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".tif")
+
+    def get(self, key):
+        """Load a background.
+
+        Args:
+            key (str): A backgroundkey().
+
+        Returns:
+            ImagePlus: The background, or None if it is not cached.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            imp = Opener().openTiff(self.directory, key + ".tif")
+            if imp is None:
+                return None
+            os.utime(path, None)
+            return imp
+        except Exception as ex:
+            IJ.log("Could not read cache {}: {}".format(path, ex))
+            return None
+
+    def put(self, key, imp):
+        """Save a background and evict the least recently used ones.
+
+        Args:
+            key (str): A backgroundkey().
+            imp (ImagePlus): The background.
+        """
+        path = self.path(key)
+        tmp = path + ".tmp"
+        try:
+            if not FileSaver(imp).saveAsTiff(tmp):
+                raise IOError("FileSaver failed")
+            with self.lock:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(tmp, path)
+                self.evict()
+        except Exception as ex:
+            IJ.log("Could not write cache {}: {}".format(path, ex))
+
+    def evict(self):
+        """Remove the least recently used backgrounds until the cache
+        fits in maxbytes."""
+        if self.maxbytes is None:
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tif"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if total <= self.maxbytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def getorcompute(self, key, compute):
+        """Load a background, or compute and cache it.
+
+        Args:
+            key (str): A backgroundkey(), or None to compute without the cache.
+            compute (function): Computes the background as ImagePlus.
+
+        Returns:
+            ImagePlus: The background.
+        """
+        if key is None:
+            return compute()
+        imp = self.get(key)
+        if imp is None:
+            imp = compute()
+            self.put(key, imp)
+        return imp
+
+
+def paramchecksum(params):
+    """Hash a set of processing parameters.
+
+    Args:
+        params: Any JSON serialisable parameters.
+
+    Returns:
+        str: The hexadecimal checksum.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+
+class JobManifest(object):
+    """Records which input files of a batch are completed, so an
+    interrupted batch resumes where it stopped.
+
+    Every completed input is stored with the checksum of the parameters
+    it was processed with, its identity (size and mtime) and its output.
+    An input counts as done only while all of these still match. The
+    manifest is a JSON file, rewritten atomically after every completed
+    input, and can be updated from several threads.
+
+    Args:
+        path (str): The manifest file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except Exception as ex:
+                IJ.log("Could not read manifest {}, starting over: {}".format(path, ex))
+
+    def isdone(self, inpath, checksum):
+        """Whether an input was completed with the same parameters.
+
+        Args:
+            inpath (str): The input file.
+            checksum (str): The paramchecksum() of the current parameters.
+
+        Returns:
+            bool: True if the input does not need processing.
+        """
+        entry = self.entries.get(os.path.abspath(inpath))
+        if entry is None or entry["params"] != checksum:
+            return False
+        if entry["source"] != _cachekey(inpath):
+            return False
+        return os.path.exists(entry["output"])
+
+    def markdone(self, inpath, checksum, outpath):
+        """Record a completed input and write the manifest.
+
+        Args:
+            inpath (str): The input file.
+            checksum (str): The paramchecksum() of the parameters used.
+            outpath (str): The output file.
+        """
+        with self.lock:
+            self.entries[os.path.abspath(inpath)] = {
+                "params": checksum, "source": _cachekey(inpath), "output": outpath}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
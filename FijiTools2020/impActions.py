@@ -1,26 +1,34 @@
 # Jorik van Rijn <jorik.vanrijn@gmail.com> - 2020
 import os
+import math
+import heapq
+from collections import deque
+from array import array
+from jarray import zeros
 import ij.IJ as IJ
+import ij.Prefs as Prefs
 import ij.io.Opener as Opener
 import ij.ImagePlus as ImagePlus
-import ij.plugin.ChannelSplitter as ChannelSplitter
-import ij.plugin.HyperStackConverter as HyperStackConverter
+import ij.ImageStack as ImageStack
+import ij.VirtualStack as VirtualStack
+import ij.CompositeImage as CompositeImage
 import ij.plugin.ZProjector as ZProjector
-import ij.plugin.RGBStackMerge as RGBStackMerge
-import ij.plugin.ImageCalculator as ImageCalculator
-import ij.plugin.StackCombiner as StackCombiner
-import ij.plugin.MontageMaker as MontageMaker
-import ij.plugin.StackCombiner as StackCombiner
-import ij.plugin.Duplicator as Duplicator
-import ij.plugin.Concatenator as Concatenator
 import ij.plugin.GaussianBlur3D as GaussianBlur3D
-from FijiTools2020.fileHandling import chunks
+import ij.plugin.filter.GaussianBlur as GaussianBlur
+import ij.process.ImageProcessor as ImageProcessor
+import ij.process.FloatProcessor as FloatProcessor
+import ij.process.Blitter as Blitter
+from java.awt import Color, Font
+from java.lang import RuntimeException, Throwable
+from java.util.concurrent import Semaphore
+from FijiTools2020.fileHandling import (chunks, getcolumns, tablechunks, spotpositions, unpackpositions, usewriter,
+                                         parallelmap, readthreads, sourcepath, backgroundkey, openvirtual, saveimage)
 
 
 def croptracks(imp, tracks, outdir, trackid="TRACK_ID",
                trackx="TRACK_X_LOCATION", tracky="TRACK_Y_LOCATION",
                trackstart="TRACK_START", trackstop="TRACK_STOP",
-               roi_x=150, roi_y=150):
+               roi_x=150, roi_y=150, writer=None, stream=False, maxopen=None, nthreads=None):
     """Function cropping ROIs from an ImagePlus stack based on a
 ResultsTable object. This function crops square ROIs from a hyperstack
 based on locations defined in the ResultsTable. The ResultsTable should
@@ -29,7 +37,9 @@ however make sense. The following headings are required: "TRACK_ID",
 
     Args:
         imp: An ImagePlus hyperstack (timelapse).
-        tracks: A getresults(ResultsTable) object (from Track statistics.csv) with the proper column names.
+        tracks: A getresults(ResultsTable) or loadcsv() table (from Track statistics.csv) with the proper
+            column names, or the chunks (or rows) of readcsv(path, TRACK_COLUMNS, chunksize) to crop the
+            tracks chunk by chunk.
         outdir: The primary output directory.
         trackid: A unique track identifier. Defaults to "TRACK_ID"
         trackxlocation: Defaults to "TRACK_X_LOCATION".
@@ -38,110 +48,318 @@ however make sense. The following headings are required: "TRACK_ID",
         trackstop: Defaults to "TRACK_STOP".
         roi_x: Width of the ROI.
         roi_y: Height of the ROI.
+        writer: An ImageWriter to save the substacks with. Defaults to
+            None (a new ImageWriter, closed when all tracks are saved).
+        stream: Crop all tracks in one pass over the frames with
+            streamcrops(), reading every plane only once. Use this for
+            virtual stacks. Defaults to False.
+        maxopen: With stream, the maximum number of tracks cropped at
+            the same time. Defaults to None (no limit).
+        nthreads: Without stream, the number of tracks cropped at the
+            same time. Virtual stacks are always read by a single thread.
+            Defaults to None (ImageJ's thread setting).
+
+    Returns:
+        A dict of file name: frame offset pairs of the saved substacks,
+        to align them in time with combinestacks().
     """
 
     cal = imp.getCalibration()
 
-    # Loop through all the tracks, extract the track position, set an
-    # ROI and crop the hyperstack.
-    for i in tracks:
-        # This loops through all tracks. Use a custom 'tracks[0:5]' to
-        # test and save time!
-
-        # Extract all needed row values.
-        i_id = int(i[trackid])
-        i_x = int(i[trackx] / cal.pixelWidth)  # TODO fix for calibration.
-        i_y = int(i[tracky] / cal.pixelHeight)  # TODO fix for calibration.
-        i_start = int(i[trackstart] / cal.frameInterval)
-        i_stop = int(i[trackstop] / cal.frameInterval)
+    # Retrieve image dimensions.
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
 
-        # Now set an ROI according to the track's xy position in the
-        # hyperstack.
-        imp.setRoi(i_x - roi_x / 2, i_y - roi_y / 2,  # upper left x, y
-                   roi_x, roi_y)  # roi x, y dimension
+    def _requests(chunk):
+        # Extract the track position and duration of all tracks in a
+        # chunk, reading the values straight from the columns.
+        ids, xs, ys, starts, stops = getcolumns(
+            chunk, (trackid, trackx, tracky, trackstart, trackstop))
+        for row in range(len(ids)):
 
-        # Retrieve image dimensions.
-        width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+            # Extract all needed row values.
+            i_id = int(ids[row])
+            i_x = int(xs[row] / cal.pixelWidth)  # TODO fix for calibration.
+            i_y = int(ys[row] / cal.pixelHeight)  # TODO fix for calibration.
+            i_start = int(starts[row] / cal.frameInterval)
+            i_stop = int(stops[row] / cal.frameInterval)
+
+            # The ROI is centered on the track's xy position in the
+            # hyperstack, for the track's time duration.
+            # frame, upper left x, upper left y
+            positions = [(t, i_x - roi_x // 2, i_y - roi_y // 2)
+                         for t in range(max(i_start, 1), min(i_stop, nFrames) + 1)]
+            yield "TRACK_ID_{}".format(i_id), positions
+
+    # The first frame of every track, to align the substacks in time.
+    frameoffsets = {}
+
+    # The substacks are written in the background while the next track
+    # is cropped.
+    with usewriter(writer) as writer:
+        if stream:
+            requests = [r for chunk in tablechunks(tracks) for r in _requests(chunk)]
+            for title, positions in requests:
+                if positions:
+                    frameoffsets["{}.tif".format(title)] = positions[0][0] - 1
+            IJ.log("Cropping {} tracks in one pass over the frames.".format(len(requests)))
+            for imp2 in streamcrops(imp, requests, roi_x, roi_y, maxopen):
+                writer.save(imp2, os.path.join(outdir, imp2.getTitle()))
+
+        else:
+            def _crop(request):
+                # And then crop this ROI for the track's time duration, and
+                # save the substack in the output directory.
+                title, positions = request
+                IJ.log("Cropping image with {}".format(title))
+                imp2 = cropframes(imp, positions, roi_x, roi_y, title)
+                if imp2 is not None:
+                    writer.save(imp2, os.path.join(outdir, "{}.tif".format(title)))
+
+            # Loop through all the tracks, one chunk of the table at a
+            # time. The tracks only read from the source stack, so the
+            # tracks of a chunk are cropped in parallel. Use a custom
+            # 'tracks[0:5]' to test and save time!
+            for chunk in tablechunks(tracks):
+                requests = list(_requests(chunk))
+                for title, positions in requests:
+                    if positions:
+                        frameoffsets["{}.tif".format(title)] = positions[0][0] - 1
+                parallelmap(_crop, requests, readthreads(imp.getStack(), nthreads))
+
+    return frameoffsets
+
+
+def gridlayout(rows):
+    """Compute where every tile of a grid goes on the canvas.
+
+    Tiles are placed left to right in their row, rows top to bottom.
+    Every row is as high as its highest tile.
 
-        # And then crop (duplicate, actually) this ROI for the track's
-        # time duration.
-        IJ.log("Cropping image with TRACK_ID: {}/{}".format(i_id+1, int(len(tracks))))
-        # Duplicator().run(firstC, lastC, firstZ, lastZ, firstT, lastT)
-        imp2 = Duplicator().run(imp, 1, nChannels, 1, nSlices, i_start, i_stop)
+    Args:
+        rows (list): A list of rows, each a list of (width, height) tile sizes.
 
-        # Save the substack in the output directory
-        outfile = os.path.join(outdir, "TRACK_ID_{}.tif".format(i_id))
-        IJ.saveAs(imp2, "Tiff", outfile)
+    Returns:
+        tuple: The (width, height) of the canvas, and a list of rows of
+            (x, y) tile offsets.
+    """
+    offsets = []
+    width, y = 0, 0
+    for row in rows:
+        x, rowheight, rowoffsets = 0, 0, []
+        for tilewidth, tileheight in row:
+            rowoffsets.append((x, y))
+            x += tilewidth
+            rowheight = max(rowheight, tileheight)
+        offsets.append(rowoffsets)
+        width = max(width, x)
+        y += rowheight
+    return (width, y), offsets
+
+
+def _gridplan(rows, frameoffsets=None, align="start"):
+    """Plan a panel of tiles that may differ in size and length.
 
+    Args:
+        rows (list): A list of rows, each a list of ImagePlus tiles.
+        frameoffsets (list, optional): A list of rows of frame offsets:
+            frame t of a tile goes to frame t + offset of the panel.
+            Defaults to None (use align).
+        align (str, optional): Without frameoffsets, "start" aligns the
+            first frames of the tiles, "end" their last frames. Defaults
+            to "start".
 
-def _horcombine(imp_collection):
-    """Combine a list of stacks with the same dimensions horizontally.
+    Returns:
+        tuple: The (width, height) of the canvas, the (nChannels,
+            nSlices, nFrames) of the panel and a list of (tile, x, y,
+            frame offset) placements.
+    """
+    (canvaswidth, canvasheight), offsets = gridlayout(
+        [[(tile.getWidth(), tile.getHeight()) for tile in row] for row in rows])
+    tiles = [tile for row in rows for tile in row]
+    nChannels = max(tile.getNChannels() for tile in tiles)
+    nSlices = max(tile.getNSlices() for tile in tiles)
+
+    if frameoffsets is None:
+        if align == "end":
+            longest = max(tile.getNFrames() for tile in tiles)
+            frameoffsets = [[longest - tile.getNFrames() for tile in row] for row in rows]
+        else:
+            frameoffsets = [[0 for tile in row] for row in rows]
+
+    placements = []
+    for row, rowoffsets, rowframeoffsets in zip(rows, offsets, frameoffsets):
+        for tile, (x, y), offset in zip(row, rowoffsets, rowframeoffsets):
+            placements.append((tile, x, y, offset))
+    nFrames = max(offset + tile.getNFrames() for tile, x, y, offset in placements)
+
+    return (canvaswidth, canvasheight), (nChannels, nSlices, nFrames), placements
+
+
+def _tileindex(tile, c, z, t, offset):
+    """The 1-based stack index of panel plane (c, z, t) in a tile, or None
+    where the tile has no such plane and the panel stays zero."""
+    t -= offset
+    if c > tile.getNChannels() or z > tile.getNSlices() or not 1 <= t <= tile.getNFrames():
+        return None
+    return tile.getStackIndex(c, z, t)
+
+
+def composegrid(rows, title="Montage", frameoffsets=None, align="start"):
+    """Compose a grid of (hyper)stacks into a single panel in one pass.
+
+    The canvas size is computed once, the output stack is allocated once,
+    and every plane of every tile is copied straight to its place. Tiles
+    must have the same type, but may differ in size, channels, slices and
+    frames: planes a tile does not have stay zero, without padding the
+    tile itself.
 
     Args:
-        imp_collection: A list of stacks.
+        rows (list): A list of rows, each a list of ImagePlus tiles.
+        title (str, optional): The title of the panel. Defaults to "Montage".
+        frameoffsets (list, optional): A list of rows of frame offsets, to
+            place a tile later in time. Defaults to None (use align).
+        align (str, optional): "start" or "end", see _gridplan(). Defaults to "start".
 
     Returns:
-        A horizontally combined stack of the input images.
+        ImagePlus: The panel.
     """
-    comb = imp_collection[0]
-    comb_channels = ChannelSplitter().split(comb)
-    comb_channels = [i.getImageStack() for i in comb_channels]
+    (canvaswidth, canvasheight), (nChannels, nSlices, nFrames), placements = \
+        _gridplan(rows, frameoffsets, align)
 
-    for imp in imp_collection:
-
-        if imp == imp_collection[0]:
-            continue
+    # Allocate the output once, then copy every tile plane into it.
+    template = rows[0][0].getProcessor()
+    outstack = ImageStack(canvaswidth, canvasheight)
+    for n in range(nChannels * nSlices * nFrames):
+        outstack.addSlice(template.createProcessor(canvaswidth, canvasheight))
 
-        imp_channels = ChannelSplitter().split(imp)
-        imp_channels = [i.getImageStack() for i in imp_channels]
-        comb_channels = [StackCombiner().combineHorizontally(i, j)
-                         for i, j in zip(comb_channels, imp_channels)]
+    for tile, x, y, offset in placements:
+        stack = tile.getStack()
+        for t in range(1, nFrames + 1):
+            for z in range(1, nSlices + 1):
+                for c in range(1, nChannels + 1):
+                    i = _tileindex(tile, c, z, t, offset)
+                    if i is not None:
+                        n = (t - 1) * nChannels * nSlices + (z - 1) * nChannels + c
+                        outstack.getProcessor(n).insert(stack.getProcessor(i), x, y)
 
-    comb_channels = [ImagePlus("C{}".format(i+1), channel)
-                     for i, channel in enumerate(comb_channels)]
-    impout = RGBStackMerge().mergeChannels(comb_channels, False) # boolean keep
-    return impout
+    return _panelimage(rows[0][0], outstack, title, (nChannels, nSlices, nFrames))
 
 
-def _vercombine(imp_collection):
-    """Combine a list of stacks with the same dimensions vertically.
+class PlaneStack(VirtualStack):
+    """A virtual stack whose planes are computed by a function when they
+    are read, so the stack can be passed to ImageJ (and saved) without
+    holding its planes in memory.
 
     Args:
-        imp_collection: A list of stacks.
-
-    Returns:
-        A vertically combined stack of the input images.
+        width (int): The plane width.
+        height (int): The plane height.
+        nplanes (int): The number of planes.
+        plane (function): Returns the plane for a 1-based stack index.
+        bitDepth (int): The bit depth of the planes.
     """
-    comb = imp_collection[0]
-    comb_channels = ChannelSplitter().split(comb)
-    comb_channels = [i.getImageStack() for i in comb_channels]
 
-    for imp in imp_collection:
+    def __init__(self, width, height, nplanes, plane, bitDepth):
+        VirtualStack.__init__(self, width, height, None, None)
+        self.setBitDepth(bitDepth)
+        self.nplanes = nplanes
+        self.plane = plane
 
-        if imp == imp_collection[0]:
-            continue
+    def getSize(self):
+        return self.nplanes
 
-        imp_channels = ChannelSplitter().split(imp)
-        imp_channels = [i.getImageStack() for i in imp_channels]
-        comb_channels = [StackCombiner().combineVertically(i, j)
-                         for i, j in zip(comb_channels, imp_channels)]
+    def getSliceLabel(self, n):
+        return None
 
-    comb_channels = [ImagePlus("C{}".format(i+1), channel)
-                     for i, channel in enumerate(comb_channels)]
-    impout = RGBStackMerge().mergeChannels(comb_channels, False) # boolean keep
+    def getProcessor(self, n):
+        return self.plane(n)
+
+
+def writegrid(rows, outdir, title="Montage", writer=None, frameoffsets=None, align="start"):
+    """Compose a grid of (hyper)stacks plane by plane, and write the panel
+to a single hyperstack TIFF.
+
+    The panel is a virtual stack: every panel plane is composed from the
+tiles when the TIFF encoder reads it, so only a single panel plane is
+held in memory and panels larger than memory can be built from virtual
+tiles. Open the result with File > Import > TIFF Virtual Stack. Tiles
+may differ in size and length, see composegrid().
+
+    Args:
+        rows (list): A list of rows, each a list of ImagePlus tiles,
+            preferably virtual stacks.
+        outdir (path): The output directory.
+        title (str, optional): The file name, without extension. Defaults to "Montage".
+        writer (ImageWriter, optional): An ImageWriter to save the panel with.
+            Defaults to None (a new ImageWriter, closed when the panel is saved).
+        frameoffsets (list, optional): A list of rows of frame offsets, to
+            place a tile later in time. Defaults to None (use align).
+        align (str, optional): "start" or "end", see _gridplan(). Defaults to "start".
+
+    Returns:
+        path: The path of the panel TIFF.
+    """
+    (canvaswidth, canvasheight), dims, placements = _gridplan(rows, frameoffsets, align)
+    nChannels, nSlices, nFrames = dims
+    template = rows[0][0].getProcessor()
+
+    def _panelplane(n):
+        # Read the same plane from every tile into a new panel plane.
+        c = (n - 1) % nChannels + 1
+        z = (n - 1) // nChannels % nSlices + 1
+        t = (n - 1) // (nChannels * nSlices) + 1
+        ip = template.createProcessor(canvaswidth, canvasheight)
+        for tile, x, y, offset in placements:
+            i = _tileindex(tile, c, z, t, offset)
+            if i is not None:
+                ip.insert(tile.getStack().getProcessor(i), x, y)
+        return ip
+
+    panel = PlaneStack(canvaswidth, canvasheight, nChannels * nSlices * nFrames, _panelplane,
+                       template.getBitDepth())
+    path = os.path.join(outdir, title + ".tif")
+    with usewriter(writer) as writer:
+        writer.save(_panelimage(rows[0][0], panel, title, dims), path)
+    return path
+
+
+def _panelimage(first, outstack, title, dims):
+    """Wrap a panel stack with the (nChannels, nSlices, nFrames) dims and
+    the colours and calibration of its first tile."""
+    nChannels, nSlices, nFrames = dims
+    impout = ImagePlus(title, outstack)
+    impout.setDimensions(nChannels, nSlices, nFrames)
+    if nChannels > 1:
+        impout = CompositeImage(impout, CompositeImage.COMPOSITE)
+        if first.isComposite() and first.getNChannels() == nChannels:
+            impout.setLuts(first.getLuts())
+    impout.setOpenAsHyperStack(True)
+    impout.setCalibration(first.getCalibration().copy())
     return impout
 
 
-def combinestacks(directory, height=5):
+def combinestacks(directory, height=5, stream=False, outdir=None, frameoffsets=None, align="start"):
     """Combine all tiff stacks in a directory to a panel.
 
     Args:
         directory: Path to a directory containing a collection of .tiff files.
         height: The height of the panel (integer). Defaults to 5. The
         width is spaces automatically.
+        stream: Open the stacks as virtual stacks, so every plane is read
+            from disk only when it is copied into the panel, and no input
+            stack is held in memory. Defaults to False.
+        outdir: With stream, do not build the panel in memory but write
+            it plane by plane to a single TIFF in this directory, see
+            writegrid(). Defaults to None.
+        frameoffsets: A dict of file name: frame offset pairs, to place
+            stacks that start later in time, like tracks. Defaults to None
+            (use align).
+        align: Without frameoffsets, "start" aligns the first frames of
+            stacks of different length, "end" their last frames. Defaults
+            to "start".
 
     Returns:
-        A combined stack of the input images.
+        A combined stack of the input images, or the path of the panel
+        TIFF written to outdir.
     """
 
     IJ.log("\nCombining stacks...")
@@ -150,77 +368,269 @@ def combinestacks(directory, height=5):
     IJ.log("Number of files: {}".format(len(files)))
     groups = chunks(files, height)
 
-    horiz = []
-    for group in groups:
-        h = [Opener().openImage(directory, imfile) for imfile in group]
-        h = _horcombine(h)
-        # h.show()
-        horiz.append(h)
-
-    montage = _vercombine(horiz)
+    # Every group is a row of the panel, composed in a single pass.
+    if stream:
+        def _open(imfile):
+            return openvirtual(os.path.join(directory, imfile))
+    else:
+        def _open(imfile):
+            return Opener().openImage(directory, imfile)
+    groups = [group for group in groups if group]
+    rows = [[_open(imfile) for imfile in group] for group in groups]
+    if frameoffsets is not None:
+        frameoffsets = [[frameoffsets.get(imfile, 0) for imfile in group] for group in groups]
+
+    if stream and outdir is not None:
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        return writegrid(rows, outdir, frameoffsets=frameoffsets, align=align)
+
+    montage = composegrid(rows, frameoffsets=frameoffsets, align=align)
     montage.show()
+    return montage
 
 
-def croppoints(imp, spots, outdir, roi_x=150, roi_y=150, ntracks=None,
-               trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y", tracktlocation="FRAME"):
-    """Function to follow and crop the individual spots within a
-trackmate "Spots statistics.csv" file.
+def _cropplane(ip, x, y, roi_x, roi_y):
+    """Crop a rectangle from an ImageProcessor, padding with zeros where
+    the rectangle crosses the image border.
 
     Args:
-        imp (ImagePlus()): An ImagePlus() stack.
-        spots (list of dictionaries): The output of a getresults() function call.
-        outdir (path): The output directory path.
+        ip (ImageProcessor): The input plane. Its roi is changed, so pass
+            a processor which is not shared, e.g. from stack.getProcessor().
+        x (int): Upper left x of the rectangle.
+        y (int): Upper left y of the rectangle.
+        roi_x (int): Rectangle width (pixels).
+        roi_y (int): Rectangle height (pixels).
+
+    Returns:
+        ImageProcessor: A new processor of roi_x by roi_y pixels.
+    """
+    width, height = ip.getWidth(), ip.getHeight()
+    if x >= 0 and y >= 0 and x + roi_x <= width and y + roi_y <= height:
+        ip.setRoi(x, y, roi_x, roi_y)
+        return ip.crop()
+
+    # Only copy the part of the rectangle that lies within the image.
+    out = ip.createProcessor(roi_x, roi_y)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + roi_x, width), min(y + roi_y, height)
+    if x1 > x0 and y1 > y0:
+        ip.setRoi(x0, y0, x1 - x0, y1 - y0)
+        out.insert(ip.crop(), x0 - x, y0 - y)
+    return out
+
+
+def _framesinrange(positions, nFrames, title=None):
+    """Drop the positions of frames outside of the hyperstack.
+
+    Args:
+        positions (list): A list of (t, x, y) tuples, as in cropframes().
+        nFrames (int): The number of frames of the hyperstack.
+        title (str, optional): Title of the output image, for the log. Defaults to None.
+
+    Returns:
+        list: The positions with 1 <= t <= nFrames.
+    """
+    inrange = [p for p in positions if 1 <= p[0] <= nFrames]
+    if len(inrange) < len(positions):
+        IJ.log("{}: {} frames outside of the image, skipped.".format(
+            title, len(positions) - len(inrange)))
+    return inrange
+
+
+def cropframes(imp, positions, roi_x=150, roi_y=150, title=None):
+    """Crop a moving ROI from a hyperstack into a new hyperstack.
+
+    The ROI pixels are read straight from the stack processors of every
+    requested (c, z, t) plane and stored in one output ImageStack which
+    is allocated up front. Every pixel is copied only once, and no
+    intermediate ImagePlus objects are created. Parts of the ROI that
+    fall outside of the image are padded with zeros, so the input image
+    never has to be resized.
+
+    Args:
+        imp (ImagePlus): The input hyperstack.
+        positions (list): A list of (t, x, y) tuples, one for every output
+            frame, with t the 1-based input frame and x, y the upper left
+            corner of the ROI in that frame. The ROI may extend beyond
+            the image borders. Frames outside of the image are skipped.
         roi_x (int, optional): ROI width (pixels). Defaults to 150.
         roi_y (int, optional): ROI height (pixels). Defaults to 150.
-        ntracks (int, optional): The number of tracks to process. Defaults to None.
-        trackid (str, optional): Column name of Track identifiers. Defaults to "TRACK_ID".
-        trackxlocation (str, optional): Column name of spot x location. Defaults to "POSITION_X".
-        trackylocation (str, optional): Column name of spot y location. Defaults to "POSITION_Y".
-        tracktlocation (str, optional): Column name of spot time location. Defaults to "FRAME".
+        title (str, optional): Title of the output image. Defaults to None.
+
+    Returns:
+        ImagePlus: The cropped hyperstack with one frame per position, or
+            None if none of the frames lie within the image.
     """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    stack = imp.getStack()
+    positions = _framesinrange(positions, nFrames, title)
+    if not positions:
+        IJ.log("{} has no frames, skipped.".format(title))
+        return None
+    outstack = ImageStack(roi_x, roi_y, nChannels * nSlices * len(positions))
+
+    n = 1
+    for t, x, y in positions:
+        for z in range(1, nSlices + 1):
+            for c in range(1, nChannels + 1):
+                index = imp.getStackIndex(c, z, t)
+                ip = _cropplane(stack.getProcessor(index), x, y,
+                                roi_x, roi_y)
+                outstack.setPixels(ip.getPixels(), n)
+                outstack.setSliceLabel(stack.getSliceLabel(index), n)
+                n += 1
+
+    return _cropimage(imp, outstack, len(positions), title)
+
+
+def _cropimage(imp, outstack, nframes, title=None):
+    """Wrap a stack of crops as hyperstack with the channels, LUTs and
+    calibration of the input image.
 
-    if ntracks == None:
-        ntracks = len(spots)
-    elif ntracks > len(spots):
-        ntracks = len(spots)
+    Args:
+        imp (ImagePlus): The input hyperstack the crops were taken from.
+        outstack (ImageStack): The cropped planes, in c, z, t order.
+        nframes (int): The number of frames in outstack.
+        title (str, optional): Title of the output image. Defaults to None.
 
-    def _cropSingleTrack(ispots):
-        """Nested function to crop the spots of a single TRACK_ID.
+    Returns:
+        ImagePlus: The cropped hyperstack.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    impout = ImagePlus(title or imp.getTitle(), outstack)
+    impout.setDimensions(nChannels, nSlices, nframes)
+    if nChannels > 1 and imp.isComposite():
+        impout = CompositeImage(impout, imp.getCompositeMode())
+        impout.setLuts(imp.getLuts())
+    impout.setOpenAsHyperStack(True)
+    impout.setCalibration(imp.getCalibration().copy())
+    return impout
 
-        Args:
-            ispots (list): List of getresults() dictionaries belonging
-            to a single track.
 
-        Returns:
-            list: A list of ImagePlus stacks of the cropped timeframes.
-        """
-        outstacks = []
+def streamcrops(imp, tracks, roi_x=150, roi_y=150, maxopen=None):
+    """Crop the moving ROIs of many tracks in a frame-major pass over a
+    hyperstack, which may be a virtual stack or Bio-Formats reader
+    backed image that does not fit in memory.
 
-        for j in ispots:
+    All requested (track, frame) pairs are sorted on frame. Every needed
+    plane is then read from the stack once per pass, and its ROIs are
+    copied to the growing output stacks of all tracks active in that
+    frame. An output stack is allocated when its track starts, and handed
+    out as soon as its last frame is cropped.
 
-            # Extract all needed row values.
-            j_id = int(j[trackid])
-            j_x = int(j[trackxlocation] * xScaleMultiplier)
-            j_y = int(j[trackylocation] * yScaleMultiplier)
-            j_t = int(j[tracktlocation] + 1)
+    At most maxopen output stacks are kept open at the same time. Tracks
+    that do not fit are deferred to a next pass over the frames, so a
+    low maxopen bounds memory at the cost of reading planes again.
 
-            # Now set an ROI according to the track's xy position in the
-            # hyperstack.
-            # upper left x, upper left y,roi x dimension, roi y dimension
-            imp.setRoi(j_x, j_y, roi_x, roi_y)
-            IJ.log("processing frame {}".format(j_t))
+    Args:
+        imp (ImagePlus): The input hyperstack.
+        tracks (list): A list of (title, positions) tuples, one for every
+            output stack, with positions as in cropframes().
+        roi_x (int, optional): ROI width (pixels). Defaults to 150.
+        roi_y (int, optional): ROI height (pixels). Defaults to 150.
+        maxopen (int, optional): Maximum number of output stacks open at
+            the same time. Defaults to None (no limit, a single pass).
 
-            # Optionally, set the correct time position in the stack.
-            # This provides cool feedback but is sloooow!
-            # imp.setPosition(1, 1, j_t)
+    Yields:
+        ImagePlus: The cropped hyperstacks, in the order they are finished.
+            Tracks without frames within the image are skipped.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    stack = imp.getStack()
+    planes = nChannels * nSlices
+
+    # Schedule the tracks on their first frame. Frames outside of the
+    # image are skipped, like in cropframes().
+    tracks = [(title, _framesinrange(positions, nFrames, title))
+              for title, positions in tracks]
+    pending = []
+    for k, (title, positions) in enumerate(tracks):
+        if not positions:
+            IJ.log("{} has no frames, skipped.".format(title))
+            continue
+        frames = [t for t, x, y in positions]
+        pending.append((min(frames), max(frames), k))
+    pending.sort()
+
+    npass = 0
+    while pending:
+        # Greedily pick the tracks for this pass: a track is opened when
+        # it starts, if fewer than maxopen tracks are still running.
+        chosen, deferred, running = [], [], []
+        for first, last, k in pending:
+            while running and running[0] < first:
+                heapq.heappop(running)
+            if maxopen is None or len(running) < maxopen:
+                heapq.heappush(running, last)
+                chosen.append(k)
+            else:
+                deferred.append((first, last, k))
+        pending = deferred
+        npass += 1
+        if deferred or npass > 1:
+            IJ.log("Crop pass {}: {} tracks.".format(npass, len(chosen)))
+
+        # Invert the requests: frame -> (track, output frame, x, y).
+        requests = {}
+        remaining = {}
+        for k in chosen:
+            title, positions = tracks[k]
+            remaining[k] = len(positions)
+            for slot, (t, x, y) in enumerate(positions):
+                requests.setdefault(t, []).append((k, slot, x, y))
+
+        outstacks = {}
+        for t in sorted(requests):
+            for z in range(1, nSlices + 1):
+                for c in range(1, nChannels + 1):
+                    index = imp.getStackIndex(c, z, t)
+                    ip = stack.getProcessor(index)
+                    label = stack.getSliceLabel(index)
+                    offset = (z - 1) * nChannels + c
+                    for k, slot, x, y in requests[t]:
+                        if k not in outstacks:
+                            outstacks[k] = ImageStack(
+                                roi_x, roi_y, planes * len(tracks[k][1]))
+                        crop = _cropplane(ip, x, y, roi_x, roi_y)
+                        outstacks[k].setPixels(crop.getPixels(), slot * planes + offset)
+                        outstacks[k].setSliceLabel(label, slot * planes + offset)
+
+            # Hand out the tracks that ended in this frame.
+            for k, slot, x, y in requests.pop(t):
+                remaining[k] -= 1
+                if remaining[k] == 0:
+                    title, positions = tracks[k]
+                    yield _cropimage(imp, outstacks.pop(k), len(positions), title)
 
-            # Crop the ROI on the corresponding timepoint and add to
-            # output stack.
-            # firstC, lastC, firstZ, lastZ, firstT, lastT
-            crop = Duplicator().run(imp, 1, dims[2], 1, dims[3], j_t, j_t)
-            outstacks.append(crop)
 
-        return outstacks
+def croppoints(imp, spots, outdir, roi_x=150, roi_y=150, ntracks=None,
+               trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y", tracktlocation="FRAME",
+               writer=None, stream=False, maxopen=None, nthreads=None):
+    """Function to follow and crop the individual spots within a
+trackmate "Spots statistics.csv" file.
+
+    Args:
+        imp (ImagePlus()): An ImagePlus() stack.
+        spots (ResultsColumns): The output of a getresults() or loadcsv() function call, or the chunks
+            of readcsv(path, SPOT_COLUMNS, chunksize) to stream the table.
+        outdir (path): The output directory path.
+        roi_x (int, optional): ROI width (pixels). Defaults to 150.
+        roi_y (int, optional): ROI height (pixels). Defaults to 150.
+        ntracks (int, optional): The number of tracks to process. Defaults to None.
+        trackid (str, optional): Column name of Track identifiers. Defaults to "TRACK_ID".
+        trackxlocation (str, optional): Column name of spot x location. Defaults to "POSITION_X".
+        trackylocation (str, optional): Column name of spot y location. Defaults to "POSITION_Y".
+        tracktlocation (str, optional): Column name of spot time location. Defaults to "FRAME".
+        writer (ImageWriter, optional): An ImageWriter to save the stacks with. Defaults to
+            None (a new ImageWriter, closed when all tracks are saved).
+        stream (bool, optional): Crop all tracks in one pass over the frames with streamcrops(),
+            reading every plane only once. Use this for virtual stacks. Defaults to False.
+        maxopen (int, optional): With stream, the maximum number of tracks cropped at the same time.
+            Defaults to None (no limit).
+        nthreads (int, optional): Without stream, the number of tracks cropped at the same time. Virtual
+            stacks are always read by a single thread. Defaults to None (ImageJ's thread setting).
+    """
 
     # START OF MAIN FUNCTION.
     # Store the stack dimensions.
@@ -241,101 +651,456 @@ trackmate "Spots statistics.csv" file.
             "Image is not spatially calibrated. Make sure the input .csv isn't either!")
         IJ.log("Physical units to pixel scale: x = {}, y = {} pixels/unit\n".format(xScaleMultiplier, yScaleMultiplier))
 
-    # Add a black frame around the stack to ensure the cropped roi's are
-    # never out of view.
-    expand_x = dims[0] + roi_x
-    expand_y = dims[1] + roi_y
-
-    # This line could be replaced by ij.plugin.CanvasResizer().
-    # However, since that function takes ImageStacks, not ImagePlus,
-    # that just makes it more difficult for now.
-    IJ.run(imp, "Canvas Size...", "width={} height={} position=Center zero".format(expand_x, expand_y))
-
-    # Retrieve all unique track ids. This is what we loop through.
-    track_ids = set([track[trackid] for track in spots])
-    track_ids = list(track_ids)
-
-    # This loop loops through the unique set of TRACK_IDs from the
-    # results table.
-    for i in track_ids[0:ntracks]:
-
-        # Extract all spots (rows) with TRACK_ID == i.
-        trackspots = [spot for spot in spots if spot[trackid] == i]
-        # Monitor progress
-        IJ.log("TRACK_ID: {}/{}".format(int(i+1), len(track_ids)))
-
-        # Crop the spot locations of the current TRACK_ID.
-        out = _cropSingleTrack(trackspots)
-
-        # Concatenate the frames into one ImagePlus and save.
-        out = Concatenator().run(out)
-        outfile = os.path.join(outdir, "TRACK_ID_{}.tif".format(int(i)))
-        IJ.saveAs(out, "Tiff", outfile)
+    # Collect the positions of all spots per track in a single pass
+    # over the table. The unique track ids are what we loop through.
+    index = spotpositions(spots, roi_x, roi_y, xScaleMultiplier, yScaleMultiplier, 1,
+                          trackid, trackxlocation, trackylocation, tracktlocation)
+    track_ids = sorted(index)[0:ntracks]
+
+    # The stacks are written in the background while the next track is
+    # cropped.
+    with usewriter(writer) as writer:
+
+        if stream:
+            # Crop all tracks in a single pass over the frames.
+            requests = [("TRACK_ID_{}".format(int(i)), unpackpositions(index.pop(i)))
+                        for i in track_ids]
+            for out in streamcrops(imp, requests, roi_x, roi_y, maxopen):
+                writer.save(out, os.path.join(outdir, out.getTitle()))
+
+        else:
+            def _cropTrack(item):
+                # Crop the spot locations of a single TRACK_ID on the
+                # corresponding timepoints into one output stack, and save.
+                # ROIs crossing the image border are padded with zeros.
+                n, (i, track) = item
+
+                # Monitor progress
+                IJ.log("TRACK_ID: {} ({}/{})".format(int(i), n+1, len(track_ids)))
+
+                out = cropframes(imp, unpackpositions(track), roi_x, roi_y,
+                                 "TRACK_ID_{}".format(int(i)))
+                if out is not None:
+                    outfile = os.path.join(outdir, "TRACK_ID_{}.tif".format(int(i)))
+                    writer.save(out, outfile)
+
+            # This loop loops through the unique set of TRACK_IDs from the
+            # results table. The tracks only read from the source stack,
+            # so they are cropped in parallel.
+            parallelmap(_cropTrack, enumerate([(i, index.pop(i)) for i in track_ids]),
+                        readthreads(imp.getStack(), nthreads))
 
     IJ.log("\nExecution croppoints() finished.")
 
 
-def makemontage(imp, hsize=5, vsize=5, increment=1):
+def makemontage(imp, hsize=5, vsize=5, increment=1, labels=True, nthreads=None):
     """Makes a montage of a multichannel ImagePlus object.
 
+    The montage tiles are read straight from the hyperstack by their
+    (c, z, t) index: frames 1, 1 + increment, 1 + 2 * increment and so
+    on, until the grid is full or the frames run out (for a z-stack
+    without frames, slices are used instead). Only the planes the grid
+    needs are read, so virtual stacks stay cheap, and the channels are
+    composed in parallel.
+
     Args:
         imp (ImagePlus): An ImagePlus object.
         hsize (int, optional): Size of the horizontal axis. Defaults to 5.
         vsize (int, optional): Size of the vertical axis. Defaults to 5.
         increment (int, optional): The increment between images. Allows for dropping of e.g. every second frame. Defaults to 1.
+        labels (bool, optional): Draw the slice label (or frame number) on every tile. Defaults to True.
+        nthreads (int, optional): Number of channels composed at the same time. Virtual stacks are read by a single thread. Defaults to None.
 
     Returns:
         ImagePlus: The montage as ImagePlus object.
     """
-    gridsize = hsize * vsize
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    stack = imp.getStack()
+    name = imp.getTitle()
+
+    # Montage the frames, or the slices of a z-stack.
+    if nFrames > 1:
+        positions = [(imp.getZ(), t) for t in range(1, nFrames + 1, increment)]
+    else:
+        positions = [(z, 1) for z in range(1, nSlices + 1, increment)]
+    positions = positions[:hsize * vsize]
 
-    def _listProduct(inlist):
-        """Calculates the product of all elements in a list.
+    def _channelmontage(c):
+        """Makes a montage of a single channel of the hyperstack.
 
         Args:
-            inlist (list): A list of numbers.
+            c (int): The 1-based channel.
 
         Returns:
-            int or double: The product of all list elements.
+            ImageProcessor: A montage of the one input channel.
         """
-        product = 1
+        montage = stack.getProcessor(1).createProcessor(width * hsize, height * vsize)
+        if labels:
+            montage.setFont(Font("SansSerif", Font.PLAIN, 12))
+            montage.setColor(Color.white)
+            montage.setAntialiasedText(True)
+
+        for i, (z, t) in enumerate(positions):
+            n = imp.getStackIndex(c, z, t)
+            x, y = (i % hsize) * width, (i // hsize) * height
+            montage.insert(stack.getProcessor(n), x, y)
+
+            if labels:
+                # Centered at the bottom of the tile, like MontageMaker.
+                label = stack.getShortSliceLabel(n) or str(t if nFrames > 1 else z)
+                montage.drawString(label, x + (width - montage.getStringWidth(label)) // 2,
+                                   y + height - 2)
+        return montage
+
+    montages = parallelmap(_channelmontage, range(1, nChannels + 1), readthreads(stack, nthreads))
+
+    outstack = ImageStack(width * hsize, height * vsize)
+    for c, montage in enumerate(montages):
+        outstack.addSlice("C{}".format(c + 1), montage)
+    montage = ImagePlus(name, outstack)
+    if nChannels > 1:
+        montage.setDimensions(nChannels, 1, 1)
+        montage = CompositeImage(montage, CompositeImage.COMPOSITE)
+        if imp.isComposite():
+            montage.setLuts(imp.getLuts())
+    elif imp.isComposite() or imp.getProcessor().isColorLut():
+        montage.getProcessor().setColorModel(imp.getProcessor().getColorModel())
+    montage.setCalibration(imp.getCalibration().copy())
+    return montage
 
-        for element in inlist:
-            if isinstance(element, (int, float)):
-                product = element * product
+def montagebytes(imp, hsize=5, vsize=5):
+    """Estimate the memory a makemontage() result of an image takes.
 
-        return product
+    Args:
+        imp (ImagePlus): An ImagePlus object, can be a virtual stack.
+        hsize (int, optional): Size of the horizontal axis. Defaults to 5.
+        vsize (int, optional): Size of the vertical axis. Defaults to 5.
 
-    def _channelmontage(_imp):
-        """Makes a montage of a single channel ImagePlus object.
+    Returns:
+        int: The size of the montage in bytes.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    bytesperpixel = {8: 1, 16: 2, 24: 4, 32: 4}[imp.getBitDepth()]
+    return width * hsize * height * vsize * nChannels * bytesperpixel
 
-        Args:
-            _imp (ImagePlus): A single channel ImagePlus object.
 
-        Returns:
-            ImagePlus: A montage of the one input channel.
-        """
-        dims = _imp.getDimensions()  # width, height, nChannels, nSlices, nFrames
-        frames = _listProduct(dims[2:])
-        if frames > gridsize:
-            frames = gridsize
-        _montage = MontageMaker().makeMontage2(
-            _imp, hsize, vsize, 1.00, 1, frames, increment, 0, True)
-        return _montage
+def batchmontage(indir, outdir, hsize=6, vsize=6, increment=2, nworkers=None, memory=None, writer=None):
+    """Make a montage of every .tif stack in a directory and save them
+in outdir.
+
+    The stacks are opened as virtual stacks, so only the planes in the
+grid are read from disk, and several stacks are montaged at the same
+time. The montages being made are kept below a memory budget: every
+worker reserves the estimated size of its montage before it starts and
+waits while the budget is used up. Saving is done in the background by
+an ImageWriter.
+
+    Args:
+        indir (path): The input directory.
+        outdir (path): The output directory.
+        hsize (int, optional): Size of the horizontal axis. Defaults to 6.
+        vsize (int, optional): Size of the vertical axis. Defaults to 6.
+        increment (int, optional): The increment between images. Defaults to 2.
+        nworkers (int, optional): The number of stacks montaged at the same time. Defaults to None (ImageJ's thread setting).
+        memory (int, optional): The memory budget in bytes. Defaults to None (half of the free memory).
+        writer (ImageWriter, optional): Queue the montages on this writer. Defaults to None (a new writer).
+
+    Returns:
+        list: The files that failed.
+    """
+    files = sorted(f for f in os.listdir(indir) if f.endswith(".tif"))
+    if memory is None:
+        memory = (IJ.maxMemory() - IJ.currentMemory()) // 2
+    # The budget is counted in MB, which fits the int permits of a Semaphore.
+    budget = max(1, int(memory // 2**20))
+    permits = Semaphore(budget)
+    failed = []
+
+    def _montage(item):
+        i, imfile = item
+        IJ.log("File: {}/{}".format(i + 1, len(files)))
+        try:
+            imp = openvirtual(os.path.join(indir, imfile))
+            # A montage larger than the budget still runs, on its own.
+            cost = min(budget, max(1, int(math.ceil(montagebytes(imp, hsize, vsize) / 2.0**20))))
+            permits.acquire(cost)
+            try:
+                # Virtual stacks are not safe to read from several
+                # threads, the parallelism is across files instead.
+                montage = makemontage(imp, hsize, vsize, increment, nthreads=1)
+                imp.close()
+                saveimage(montage, outdir, writer)
+            finally:
+                permits.release(cost)
+        except (Exception, Throwable) as ex:
+            IJ.log("Something in batchmontage() went wrong: {}".format(type(ex).__name__, ex.args))
+            failed.append(imfile)
+
+    with usewriter(writer) as writer:
+        parallelmap(_montage, list(enumerate(files)), nworkers)
+    return failed
+
+
+# The number of histogram counts slidingmedian() keeps at once (64 MB).
+MEDIAN_COUNTS = 1 << 24
+
+# The smallest window (in planes) that slidingmedian() keeps rolling
+# histograms for. The histogram loops run per pixel in Jython, which only
+# pays off against ZProjector's Java median for wide windows.
+MEDIAN_WINDOW = 64
+
+
+def slidingmedian(stack, indices, window=3, step=1, maxcounts=MEDIAN_COUNTS):
+    """Temporal median filter over a sliding window of stack planes.
+
+    The window of output i holds the planes indices[i*step] up to and
+    including indices[i*step + window], clipped at the end of the
+    series, like glidingprojection(). Windows of fewer than MEDIAN_WINDOW
+    planes are projected with ZProjector. For wider windows of 8 and
+    16-bit stacks a rolling histogram over the value range of the series
+    is kept for every pixel, in Java int arrays: when the window
+    advances, the values of the planes that leave it are counted out and
+    those of the planes that enter it are counted in. The median bin of
+    every pixel starts at its value in the first plane and is tracked
+    along (Huang's algorithm), so it only has to move by the few bins
+    the window changed it by. The image is processed in strips of rows,
+    so the histograms never hold more than maxcounts counts.
+
+    Float and virtual stacks (whose planes would be read again for every
+    strip), and value ranges too wide for a single row of histograms
+    within maxcounts, are projected with ZProjector as well.
+
+    Args:
+        stack (ImageStack): The input stack (8, 16 or 32-bit).
+        indices (list): The 1-based stack indices of the series, in time order.
+        window (int, optional): The number of planes after the first
+            plane in each window. Defaults to 3.
+        step (int, optional): The number of planes to advance the window
+            per output. Defaults to 1.
+        maxcounts (int, optional): The maximum number of histogram counts
+            held at once. Defaults to MEDIAN_COUNTS.
+
+    Returns:
+        list: The median of every window, in time order.
+    """
+    bitdepth = stack.getBitDepth()
+    if window + 1 < MEDIAN_WINDOW or bitdepth not in (8, 16) or stack.isVirtual():
+        return list(_slidingprojection(stack, indices, window, step, "Median"))
+
+    width, height = stack.getWidth(), stack.getHeight()
+
+    # One bin for every value in the range of the series.
+    mask = 0xff if bitdepth == 8 else 0xffff
+    stats = [stack.getProcessor(i).getStats() for i in indices]
+    lowest = int(min(stat.min for stat in stats))
+    nbins = int(max(stat.max for stat in stats)) - lowest + 1
+    rows = maxcounts // (nbins * width)
+    if not rows:
+        return list(_slidingprojection(stack, indices, window, step, "Median"))
+
+    last = len(indices) - 1
+    starts = range(0, len(indices), step)
+    outputs = [zeros(width * height, "f") for start in starts]
+
+    for y in range(0, height, rows):
+        offset = y * width
+        npix = min(rows, height - y) * width
+        histograms = zeros(npix * nbins, "i")
+        # The median bin of every pixel and the number of values below
+        # it, starting at the value in the first plane.
+        pixels = stack.getPixels(indices[0])
+        medians = array("i", [(pixels[offset + p] & mask) - lowest for p in range(npix)])
+        below = zeros(npix, "i")
+        planes = deque()
+
+        for o, start in enumerate(starts):
+            stop = min(start + window, last)
+
+            # Count out the planes that left the window.
+            while planes and planes[0] < start:
+                pixels = stack.getPixels(indices[planes.popleft()])
+                for p in range(npix):
+                    value = (pixels[offset + p] & mask) - lowest
+                    histograms[p * nbins + value] -= 1
+                    if value < medians[p]:
+                        below[p] -= 1
+
+            # Count in the planes that entered the window.
+            first = planes[-1] + 1 if planes else start
+            for i in range(first, stop + 1):
+                planes.append(i)
+                pixels = stack.getPixels(indices[i])
+                for p in range(npix):
+                    value = (pixels[offset + p] & mask) - lowest
+                    histograms[p * nbins + value] += 1
+                    if value < medians[p]:
+                        below[p] += 1
+
+            # Move every median bin to the middle value, and take the
+            # median like ZProjector does.
+            n = len(planes)
+            k = n // 2
+            out = outputs[o]
+            for p in range(npix):
+                base = p * nbins
+                m, b = medians[p], below[p]
+                while b > k:
+                    m -= 1
+                    b -= histograms[base + m]
+                while b + histograms[base + m] <= k:
+                    b += histograms[base + m]
+                    m += 1
+                medians[p], below[p] = m, b
+                if n % 2 or b < k:
+                    out[offset + p] = m + lowest
+                else:
+                    # The lower middle value is in the next lower bin.
+                    lower = m - 1
+                    while not histograms[base + lower]:
+                        lower -= 1
+                    out[offset + p] = (lower + m) / 2.0 + lowest
+
+    return [FloatProcessor(width, height, out) for out in outputs]
+
+
+# Method name: ZProjector constant pairs for the projection methods.
+PROJECTION_METHODS = dict(zip(
+    ['Average Intensity', 'Max Intensity', 'Min Intensity', 'Sum Slices',
+     'Standard Deviation', 'Median'],
+    [ZProjector.AVG_METHOD, ZProjector.MAX_METHOD, ZProjector.MIN_METHOD,
+     ZProjector.SUM_METHOD, ZProjector.SD_METHOD, ZProjector.MEDIAN_METHOD]))
+
+
+def _slidingprojection(stack, indices, window=3, step=1, projectionmethod="Median"):
+    """Project a sliding window of stack planes with ZProjector.
+
+    Args:
+        stack (ImageStack): The input stack.
+        indices (list): The 1-based stack indices of the series, in time order.
+        window (int, optional): The number of planes after the first
+            plane in each window. Defaults to 3.
+        step (int, optional): The number of planes to advance the window
+            per output. Defaults to 1.
+        projectionmethod (str, optional): One of PROJECTION_METHODS.
+            Defaults to "Median".
+
+    Yields:
+        ImageProcessor: The projection of every window, in time order.
+    """
+    for start in range(0, len(indices), step):
+        yield projectwindow(stack, indices[start:start + window + 1], projectionmethod)
+
+
+def projectwindow(stack, indices, projectionmethod="Median"):
+    """Project a window of stack planes with ZProjector.
+
+    Args:
+        stack (ImageStack): The input stack.
+        indices (list): The 1-based stack indices of the window.
+        projectionmethod (str, optional): One of PROJECTION_METHODS.
+            Defaults to "Median".
+
+    Returns:
+        ImageProcessor: The projection.
+    """
+    windowstack = ImageStack(stack.getWidth(), stack.getHeight())
+    for i in indices:
+        windowstack.addSlice(stack.getProcessor(i))
+    zp = ZProjector(ImagePlus("window", windowstack))
+    zp.setMethod(PROJECTION_METHODS[projectionmethod])
+    zp.doProjection()
+    return zp.getProjection().getProcessor()
+
+
+def temporalfilter(imp, window=3, step=1, projectionmethod="Median",
+                   startframe=1, stopframe=None, channels=None, nthreads=None):
+    """Project a sliding window along the time axis of a hyperstack.
+
+    Each (channel, slice) series is filtered on its own: planes are read
+    straight from the stack by their (c, z, t) index, so channels and
+    slices never end up in the same window and no ChannelSplitter or
+    HyperStackConverter round trips are needed. The series are processed
+    in parallel.
+
+    Args:
+        imp (ImagePlus): The input hyperstack.
+        window (int, optional): The number of frames after the first
+            frame in each window. Defaults to 3.
+        step (int, optional): The number of frames to advance the window
+            per output frame. Defaults to 1.
+        projectionmethod (str, optional): One of PROJECTION_METHODS.
+            Defaults to "Median".
+        startframe (int, optional): The first frame to filter. Defaults to 1.
+        stopframe (int, optional): The last frame to filter. Defaults to
+            None (the last frame).
+        channels (list, optional): The 1-based channels to filter.
+            Defaults to None (all channels).
+        nthreads (int, optional): The number of series processed at the
+            same time. Virtual stacks are read by a single thread.
+            Defaults to None (ImageJ's thread setting).
+
+    Returns:
+        ImagePlus: The filtered hyperstack with only the chosen channels.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    stack = imp.getStack()
+    if stopframe is None:
+        stopframe = nFrames
+    if channels is None:
+        channels = range(1, nChannels + 1)
+    channels = list(channels)
+    frames = range(startframe, stopframe + 1)
+    allseries = [(c, z) for c in channels for z in range(1, nSlices + 1)]
+    nthreads = readthreads(stack, nthreads)
+    if nthreads is None:
+        nthreads = Prefs.getThreads()
+    # The series filtered at the same time share the histogram memory.
+    maxcounts = MEDIAN_COUNTS // max(1, min(nthreads, len(allseries)))
+
+    def _filterseries(series):
+        c, z = series
+        indices = [imp.getStackIndex(c, z, t) for t in frames]
+        if projectionmethod == 'Median':
+            # Update wide median windows incrementally instead of
+            # projecting every window from scratch.
+            return slidingmedian(stack, indices, window, step, maxcounts)
+        return list(_slidingprojection(stack, indices, window, step,
+                                       projectionmethod))
+
+    results = parallelmap(_filterseries, allseries, nthreads)
+
+    # Put every filtered plane at its (c, z, t) position.
+    nOut = len(results[0])
+    outC = len(channels)
+    outstack = ImageStack(width, height, outC * nSlices * nOut)
+    for (c, z), planes in zip(allseries, results):
+        for t, ip in enumerate(planes):
+            n = t * outC * nSlices + (z - 1) * outC + channels.index(c) + 1
+            outstack.setPixels(ip.getPixels(), n)
+
+    impout = ImagePlus(imp.getTitle(), outstack)
+    impout.setDimensions(outC, nSlices, nOut)
+    if outC > 1:
+        impout = CompositeImage(impout, CompositeImage.COMPOSITE)
+    if imp.isComposite():
+        luts = imp.getLuts()
+        if outC > 1:
+            impout.setLuts([luts[c - 1] for c in channels])
+        else:
+            impout.getProcessor().setColorModel(luts[channels[0] - 1])
+    impout.setOpenAsHyperStack(True)
+    impout.setCalibration(imp.getCalibration().copy())
+    return impout
 
-    name = imp.getTitle()
-    channels = ChannelSplitter().split(imp)
-    montages = [_channelmontage(channel) for channel in channels]
-    montage = RGBStackMerge().mergeChannels(montages, False)
-    montage.setTitle(name)
-    return montage
 
 # '''This function is based on Jens Eriksson's Collective Migration Buddy v2.0
 # (https://github.com/Oftatkofta/ImageJ-plugins)
-def glidingprojection(imp, startframe=1, stopframe=None, glidingFlag=True, no_frames_per_integral=3, projectionmethod="Median"):
+def glidingprojection(imp, startframe=1, stopframe=None, glidingFlag=True, no_frames_per_integral=3, projectionmethod="Median",
+                      channels=None, nthreads=None, cache=None, source=None, channel=None):
     """This function subtracts the gliding projection of several frames
 from the input stack. Thus, everything which moves too fast is filtered
-away.
+away. Every channel and slice of a hyperstack is projected separately
+along time, see temporalfilter().
 
     Args:
         imp (ImagePlus): Input image as ImagePlus object.
@@ -344,6 +1109,12 @@ away.
         glidingFlag (bool, optional): Should a gliding frame by frame projection be used? Defaults to True.
         no_frames_per_integral (int, optional): Number of frames to project each integral. Defaults to 3.
         projectionmethod (str, optional): Choose the projection method. Options are 'Average Intensity', 'Max Intensity', 'Min Intensity', 'Sum Slices', 'Standard Deviation', 'Median'. Defaults to "Median".
+        channels (list, optional): Only project these (1-based) channels. Defaults to None (all channels).
+        nthreads (int, optional): Number of channel/slice series projected at the same time. Defaults to None.
+        cache (BackgroundCache, optional): Reuse the projection of an earlier run from this cache. Defaults to None.
+        source (str, optional): The source file of imp, for the cache key. Defaults to None (the file imp was opened from).
+        channel (int, optional): The channel of the source that a single-channel imp holds, for the cache key.
+            Defaults to None (the channels of imp are the channels of the source).
 
     Raises:
         RuntimeException: Start frame > stop frame.
@@ -352,7 +1123,6 @@ away.
         ImagePlus: The output stack.
     """
     # Store some image properties.
-    cal = imp.getCalibration()
     width, height, nChannels, nSlices, nFrames = imp.getDimensions()
     title = imp.getTitle()
 
@@ -363,48 +1133,415 @@ away.
         IJ.showMessage("Start frame > Stop frame, can't go backwards in time!")
         raise RuntimeException("Start frame > Stop frame!")
 
-    # If a subset of the image is to be projected, these lines of code handle that.
-    if ((startframe != 1) or (stopframe != nFrames)):
-        imp = Duplicator().run(imp, 1, nChannels, 1, nSlices, startframe, stopframe)
-
     # Define the number of frames to advance per step based on boolean input parameter glidingFlag.
     if glidingFlag:
         frames_to_advance_per_step = 1
     else:
         frames_to_advance_per_step = no_frames_per_integral
 
-    # Make a dict containg method_name:const_fieled_value pairs for the projection methods
-    methods_as_strings = ['Average Intensity', 'Max Intensity',
-                          'Min Intensity', 'Sum Slices', 'Standard Deviation',
-                          'Median']
-    methods_as_const = [ZProjector.AVG_METHOD, ZProjector.MAX_METHOD,
-                        ZProjector.MIN_METHOD, ZProjector.SUM_METHOD,
-                        ZProjector.SD_METHOD, ZProjector.MEDIAN_METHOD]
-    method_dict = dict(zip(methods_as_strings, methods_as_const))
-
-    # Initialize a ZProjector object and an empty stack to collect projections.
-    zp = ZProjector(imp)
-    zp.setMethod(method_dict[projectionmethod])
-    outstack = imp.createEmptyStack()
-
-    # Loop through all the frames in the image, and project that frame with the other frames in the integral.
-    for frame in range(1, nFrames+1, frames_to_advance_per_step):
-        zp.setStartSlice(frame)
-        zp.setStopSlice(frame+no_frames_per_integral)
-        zp.doProjection()
-        outstack.addSlice(zp.getProjection().getProcessor())
-
-    # Create an image processor from the newly created Z-projection stack
-    # nFrames = outstack.getSize()/nChannels
-    impout = ImagePlus(title+'_'+projectionmethod+'_' +
-                       str(no_frames_per_integral)+'_frames', outstack)
-    impout = HyperStackConverter.toHyperStack(impout, nChannels, 
-                                              nSlices, nFrames)
-    impout.setCalibration(cal)
+    # Project every frame with the other frames in the integral, for
+    # every channel and slice.
+    def _project():
+        return temporalfilter(imp, no_frames_per_integral,
+                              frames_to_advance_per_step, projectionmethod,
+                              startframe, stopframe, channels, nthreads)
+
+    params = {"window": no_frames_per_integral, "step": frames_to_advance_per_step,
+              "method": projectionmethod, "start": startframe, "stop": stopframe}
+    if channel is None:
+        channel = channels
+    impout = _cachedbackground(cache, imp, source, channel, "gliding", params, _project)
+    impout.setTitle(title+'_'+projectionmethod+'_' +
+                    str(no_frames_per_integral)+'_frames')
     return impout
 
 
-def subtractzproject(imp, projectionMethod="Median"):
+def processplanes(func, nplanes, nthreads=None):
+    """Run a function on every plane of a stack in parallel.
+
+    The planes of a stack are independent once a background has been
+computed, so blurring, subtraction and type conversion can be spread
+over all cores. The stack is split over the threads by plane, and the
+results are returned in plane order whatever order they finish in.
+
+    Args:
+        func (function): Takes a 1-based stack index. It should only
+            read from shared stacks.
+        nplanes (int): The number of planes in the stack.
+        nthreads (int, optional): The number of planes processed at the
+            same time. Defaults to None (ImageJ's thread setting).
+
+    Returns:
+        list: The results of func for planes 1 to nplanes, in plane order.
+    """
+    return parallelmap(func, range(1, nplanes + 1), nthreads)
+
+
+def _keepplanes(func, planebytes, maxbytes=None):
+    """Remember the planes a plane function returns, as far as they fit
+in memory, so they are computed only once over several passes.
+
+    Args:
+        func (function): Returns a plane for a 1-based stack index. The
+            planes must not be changed by the caller.
+        planebytes (int): The size of a plane in bytes.
+        maxbytes (int, optional): The memory to use. Defaults to None
+            (half of the free memory).
+
+    Returns:
+        function: Returns the plane for a 1-based stack index.
+    """
+    if maxbytes is None:
+        maxbytes = (IJ.maxMemory() - IJ.currentMemory()) // 2
+    # The first planes are kept, the others computed again on every pass.
+    maxplane = maxbytes // planebytes
+    planes = {}
+
+    def _plane(n):
+        if n > maxplane:
+            return func(n)
+        try:
+            return planes[n]
+        except KeyError:
+            ip = planes[n] = func(n)
+            return ip
+
+    return _plane
+
+
+# Operation name: Blitter mode pairs for subtractbackground().
+BACKGROUND_OPERATIONS = {"subtract": Blitter.SUBTRACT, "divide": Blitter.DIVIDE}
+
+
+def _floatcopy(ip):
+    # A float copy of a plane that can be changed in place. Converting a
+    # FloatProcessor returns the plane itself, which may be a stack plane.
+    if isinstance(ip, FloatProcessor):
+        return ip.duplicate()
+    return ip.convertToFloatProcessor()
+
+
+def _subtractplane(ip, background, square=False, operation="subtract"):
+    """Subtract a background from a single plane in float.
+
+    Args:
+        ip (ImageProcessor): The input plane.
+        background (FloatProcessor): The background plane.
+        square (bool, optional): Square the difference. Defaults to False.
+        operation (str, optional): "subtract" or "divide". Defaults to "subtract".
+
+    Returns:
+        FloatProcessor: The background subtracted plane.
+    """
+    fp = _floatcopy(ip)
+    fp.copyBits(background, 0, 0, BACKGROUND_OPERATIONS[operation])
+    if square:
+        fp.sqr()
+    return fp
+
+
+def _saturatedrange(histogram, histmin, binsize, saturated):
+    """Find the display range that saturates a percentage of pixels,
+like "Enhance Contrast..." does.
+
+    Args:
+        histogram (list): The pixel counts per bin.
+        histmin (float): The value of the first bin.
+        binsize (float): The width of a bin.
+        saturated (float): The percentage of saturated pixels, split
+            evenly over the low and high end of the histogram.
+
+    Returns:
+        tuple: The (min, max) display range.
+    """
+    threshold = int(sum(histogram) * saturated / 200.0)
+    hmin, count = 0, 0
+    while hmin < len(histogram) - 1:
+        count += histogram[hmin]
+        if count > threshold:
+            break
+        hmin += 1
+    hmax, count = len(histogram) - 1, 0
+    while hmax > 0:
+        count += histogram[hmax]
+        if count > threshold:
+            break
+        hmax -= 1
+    if hmax < hmin:
+        return histmin, histmin + len(histogram) * binsize
+    return histmin + hmin * binsize, histmin + hmax * binsize
+
+
+def displayrange(plane, nplanes, saturated=None, bitDepth=8, nthreads=None):
+    """Find the range of a stream of float planes that is scaled to the
+output bit depth.
+
+    Args:
+        plane (function): Returns a FloatProcessor for a 1-based plane
+            index, which may be changed.
+        nplanes (int): The number of planes.
+        saturated (float, optional): The percentage of saturated pixels
+            in the histogram of all planes, like "Enhance Contrast...
+            saturated=0.3 normalize process_all use". This takes a pass
+            for the range and a pass for the histogram. Defaults to None:
+            the range of the first plane, like the "8-bit" command.
+        bitDepth (int, optional): The output bit depth. Defaults to 8.
+        nthreads (int, optional): The number of planes processed at the
+            same time. Defaults to None.
+
+    Returns:
+        tuple: The (min, max) range, (0, 1) for unscaled 32-bit output.
+    """
+    def _range(n):
+        stats = plane(n).getStats()
+        return stats.min, stats.max
+
+    def _histogram(n):
+        fp = plane(n)
+        fp.setHistogramSize(nbins)
+        fp.setHistogramRange(lo, lo + nbins * binsize)
+        return list(fp.getStats().histogram)
+
+    if bitDepth == 32 and saturated is None:
+        # Unscaled 32-bit output, there is no range to find or check.
+        return 0, 1
+
+    if saturated is not None:
+        # A first pass for the stack range, a second one for the stack
+        # histogram.
+        ranges = processplanes(_range, nplanes, nthreads)
+        lo = min(r[0] for r in ranges)
+        hi = max(r[1] for r in ranges)
+        nbins = 256
+        binsize = (hi - lo) / nbins if hi > lo else 1.0
+        histogram = [sum(counts) for counts in
+                     zip(*processplanes(_histogram, nplanes, nthreads))]
+        lo, hi = _saturatedrange(histogram, lo, binsize, saturated)
+    else:
+        fp = plane(1)
+        fp.resetMinAndMax()
+        lo, hi = fp.getMin(), fp.getMax()
+    if hi <= lo:
+        hi = lo + 1
+    return lo, hi
+
+
+def convertplane(fp, lo, hi, bitDepth=8, saturated=None):
+    """Scale a float plane from a display range to the output bit depth.
+
+    Args:
+        fp (FloatProcessor): The input plane, which may be changed.
+        lo (float): The value scaled to 0.
+        hi (float): The value scaled to the maximum of the bit depth.
+        bitDepth (int, optional): 8, 16 or 32. Defaults to 8.
+        saturated (float, optional): If set, 32-bit output is normalised
+            to 0-1, otherwise it is returned unscaled. Defaults to None.
+
+    Returns:
+        ImageProcessor: The converted plane.
+    """
+    if bitDepth == 8:
+        fp.setMinAndMax(lo, hi)
+        return fp.convertToByteProcessor(True)
+    elif bitDepth == 16:
+        fp.setMinAndMax(lo, hi)
+        return fp.convertToShortProcessor(True)
+    elif saturated is not None:
+        # Normalise 32-bit output to 0-1, like "Enhance Contrast..." does.
+        fp.subtract(lo)
+        fp.multiply(1.0 / (hi - lo))
+    return fp
+
+
+def backgroundplanes(background):
+    """The background plane function of a background, see
+subtractbackground().
+
+    Args:
+        background (ImageProcessor, ImageStack or function): A single
+            background plane, a stack with one background plane per
+            input plane, or a function that returns the background plane
+            for a 1-based stack index.
+
+    Returns:
+        function: Returns the background FloatProcessor for a 1-based
+            stack index.
+    """
+    if isinstance(background, ImageStack):
+        def _background(n):
+            return background.getProcessor(n).convertToFloatProcessor()
+    elif callable(background):
+        _background = background
+    else:
+        bgfp = background.convertToFloatProcessor()
+
+        def _background(n):
+            return bgfp
+    return _background
+
+
+def subtractbackground(imp, background, square=False, saturated=None, bitDepth=8, operation="subtract",
+                       nthreads=None):
+    """Subtract a background from every plane of a stack, and write the
+result straight to the target bit depth.
+
+    This fuses "Subtract create 32-bit stack", the optional "Square",
+"Enhance Contrast..." and the bit depth conversion into one plane by
+plane operation, so only one plane is held in float at a time instead
+of a 32-bit copy of the whole stack.
+
+    Args:
+        imp (ImagePlus): The input stack.
+        background (ImageProcessor, ImageStack or function): A single
+            background plane subtracted from every plane, a stack with
+            one background plane per input plane, or a function that
+            returns the background plane for a 1-based stack index, see
+            blurbackground().
+        square (bool, optional): Square the pixel values after
+            subtraction. Defaults to False.
+        saturated (float, optional): Normalise the contrast of the whole
+            stack with this percentage of saturated pixels, like
+            "Enhance Contrast... saturated=0.3 normalize process_all use".
+            Defaults to None, which scales like the "8-bit" command does:
+            by the display range of the first plane.
+        bitDepth (int, optional): The output bit depth, 8, 16 or 32. A
+            32-bit output without saturated is not scaled. Defaults to 8.
+        operation (str, optional): "subtract" the background, or
+            "divide" by it to correct uneven illumination. Defaults to
+            "subtract".
+        nthreads (int, optional): The number of planes processed at the
+            same time, see processplanes(). Virtual stacks are read by a
+            single thread. Defaults to None.
+
+    Returns:
+        ImagePlus: The background subtracted stack.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    stack = imp.getStack()
+    nplanes = stack.getSize()
+    nthreads = readthreads(stack, nthreads)
+
+    _background = backgroundplanes(background)
+    if callable(background) and saturated is not None:
+        # The saturated range takes two passes over the planes before
+        # they are converted, so keep the computed background planes
+        # that fit in memory instead of computing them three times.
+        _background = _keepplanes(_background, width * height * 4)
+
+    def _plane(n):
+        return _subtractplane(stack.getProcessor(n), _background(n), square, operation)
+
+    # Find the range that is scaled to the output bit depth.
+    lo, hi = displayrange(_plane, nplanes, saturated, bitDepth, nthreads)
+
+    def _convert(n):
+        return convertplane(_plane(n), lo, hi, bitDepth, saturated).getPixels()
+
+    # Write every plane straight to the output bit depth.
+    outstack = ImageStack(width, height, nplanes)
+    for n, pixels in enumerate(processplanes(_convert, nplanes, nthreads), 1):
+        outstack.setPixels(pixels, n)
+        outstack.setSliceLabel(stack.getSliceLabel(n), n)
+
+    impout = ImagePlus(imp.getTitle(), outstack)
+    impout.setDimensions(nChannels, nSlices, nFrames)
+    if imp.isComposite():
+        impout = CompositeImage(impout, imp.getMode())
+        impout.setLuts(imp.getLuts())
+    impout.setOpenAsHyperStack(imp.isHyperStack())
+    if saturated is not None and bitDepth == 32:
+        impout.setDisplayRange(0, 1)
+    impout.setCalibration(imp.getCalibration().copy())
+    return impout
+
+
+def _cachedbackground(cache, imp, source, channel, method, params, compute):
+    """Compute a background, or load it from a BackgroundCache.
+
+    Args:
+        cache (BackgroundCache): The cache, or None to always compute.
+        imp (ImagePlus): The input image.
+        source (str): The source file of imp, or None to use the file imp
+            was opened from. Without a known source nothing is cached.
+        channel (int): The channel of the source that imp holds.
+        method (str): The name of the background method.
+        params (dict): The parameters of the method.
+        compute (function): Computes the background as ImagePlus.
+
+    Returns:
+        ImagePlus: The background.
+    """
+    if cache is None:
+        return compute()
+    if source is None:
+        source = sourcepath(imp)
+    if source is None:
+        IJ.log("The source of {} is unknown, its background is not cached.".format(imp.getTitle()))
+        return compute()
+    return cache.getorcompute(backgroundkey(source, channel, method, params), compute)
+
+
+def projectbackground(imp, projectionMethod="Median", maxframes=None, cache=None, source=None, channel=1):
+    """Project the frames of a stack into a background plane, optionally
+from an evenly spaced temporal subsample of its frames.
+
+    Every channel and slice of a hyperstack is projected along time on
+its own: the frames of a (channel, slice) series are read by their
+stack index, so channels and slices never end up in the same
+projection. The subsample is collected as plane references (or, for
+virtual stacks, single plane reads) into a small stack, so at most
+maxframes planes are projected at once. A median of a few hundred
+frames is a good estimate of the static background of even very long
+movies, which do not fit in memory as a whole.
+
+    Args:
+        imp (ImagePlus): The input stack.
+        projectionMethod (str, optional): Choose the projection method. Options are
+            'Average Intensity', 'Max Intensity', 'Min Intensity', 'Sum Slices', 'Standard Deviation', 'Median'.
+            Defaults to "Median".
+        maxframes (int, optional): The maximum number of frames to project. Defaults to
+            None (all frames).
+        cache (BackgroundCache, optional): Load the background from, or save it to, this cache.
+            Defaults to None.
+        source (str, optional): The source file of imp, for the cache key. Defaults to None (the
+            file imp was opened from).
+        channel (int, optional): The channel of the source that imp holds. Defaults to 1.
+
+    Returns:
+        ImageProcessor or ImageStack: The background plane, or for a hyperstack with several
+            channels or slices, a stack with the background plane of every (channel, slice), in
+            the order of the stack.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+
+    def _project():
+        stack = imp.getStack()
+        frames = range(1, nFrames + 1)
+        if maxframes is not None and maxframes < nFrames:
+            # Spread the subsample evenly over the frames.
+            frames = [1 + i * nFrames // maxframes for i in range(maxframes)]
+
+        backgrounds = ImageStack(width, height)
+        for z in range(1, nSlices + 1):
+            for c in range(1, nChannels + 1):
+                substack = ImageStack(width, height)
+                for t in frames:
+                    substack.addSlice(stack.getProcessor(imp.getStackIndex(c, z, t)))
+                zp = ZProjector(ImagePlus("subsample", substack))
+                zp.setMethod(PROJECTION_METHODS[projectionMethod])
+                zp.doProjection()
+                backgrounds.addSlice(zp.getProjection().getProcessor())
+        return ImagePlus("background", backgrounds)
+
+    params = {"method": projectionMethod, "maxframes": maxframes, "series": "frames"}
+    background = _cachedbackground(cache, imp, source, channel, "projection", params, _project)
+    if background.getStackSize() == 1:
+        return background.getProcessor()
+    return background.getStack()
+
+
+def subtractzproject(imp, projectionMethod="Median", square=False, saturated=None, bitDepth=32,
+                     maxframes=None, nthreads=None, cache=None, source=None, channel=1):
     """This function takes an input stack, and subtracts a projection from the 
     whole stack from each individual frame. Thereby, everything that is
     not moving in a timeseries is filtered away.
@@ -414,39 +1551,146 @@ def subtractzproject(imp, projectionMethod="Median"):
         projectionMethod (str, optional): Choose the projection method. Options are 
             'Average Intensity', 'Max Intensity', 'Min Intensity', 'Sum Slices', 'Standard Deviation', 'Median'. 
             Defaults to "Median".
+        square (bool, optional): Square the pixel values after subtraction. Defaults to False.
+        saturated (float, optional): Normalise the contrast with this percentage of saturated pixels.
+            Defaults to None, see subtractbackground().
+        bitDepth (int, optional): The output bit depth. Defaults to 32 (the unscaled difference). Ask for
+            8 or 16 to write the output at that depth directly, without a 32-bit copy of the stack.
+        maxframes (int, optional): Project the background from an evenly spaced subsample of at most
+            this many frames, to bound memory use on long (virtual) stacks. Defaults to None (all frames).
+        nthreads (int, optional): Number of planes subtracted at the same time. Defaults to None.
+        cache (BackgroundCache, optional): Reuse the projection of an earlier run from this cache.
+            Defaults to None.
+        source (str, optional): The source file of imp, for the cache key. Defaults to None.
+        channel (int, optional): The channel of the source that imp holds. Defaults to 1.
 
     Returns:
         ImagePlus: The resulting stack.
     """
-    # Start by getting the active image window and get the current active
-    # channel and other stats
-    cal = imp.getCalibration()
-    title = imp.getTitle()
+    # Run Z-Projection.
+    background = projectbackground(imp, projectionMethod, maxframes, cache, source, channel)
 
-    # Define a dictionary containg method_name:const_fieled_value pairs
-    # for the projection methods.
-    methods_as_strings = ['Average Intensity', 'Max Intensity',
-                          'Min Intensity', 'Sum Slices', 'Standard Deviation',
-                          'Median']
-    methods_as_const = [ZProjector.AVG_METHOD, ZProjector.MAX_METHOD,
-                        ZProjector.MIN_METHOD, ZProjector.SUM_METHOD,
-                        ZProjector.SD_METHOD, ZProjector.MEDIAN_METHOD]
-    method_dict = dict(zip(methods_as_strings, methods_as_const))
+    if isinstance(background, ImageStack):
+        # Subtract the background of the plane's own channel and slice.
+        nChannels = imp.getNChannels()
+        backgrounds = [background.getProcessor(i).convertToFloatProcessor()
+                       for i in range(1, background.getSize() + 1)]
 
-    # Run Z-Projection.
-    zp = ZProjector(imp)
-    zp.setMethod(method_dict[projectionMethod])
-    zp.doProjection()
-    impMedian = zp.getProjection()
+        def _background(n):
+            c, z, t = imp.convertIndexToPosition(n)
+            return backgrounds[(z - 1) * nChannels + c - 1]
+
+        background = _background
+
+    # Subtract Z-Projection plane by plane in a second pass and return
+    # output ImagePlus.
+    return subtractbackground(imp, background, square, saturated, bitDepth, nthreads=nthreads)
+
+
+def _downsampledsize(width, height, sigmaX, sigmaY, tolerance):
+    # The smallest plane size within the tolerance, see blurbackground().
+    minsigma = math.sqrt(1.0 / (8 * tolerance))
+    factor = max(1, int(min(sigmaX, sigmaY) / minsigma))
+    return max(1, width // factor), max(1, height // factor)
 
-    # Subtract Z-Projection and return output ImagePlus.
-    impout = ImageCalculator().run("Subtract create 32-bit stack", 
-                                   imp, impMedian)
-    impout.setCalibration(cal)
-    return impout
 
+def blurplane(ip, sigmaX=30, sigmaY=30, tolerance=None):
+    """Gaussian blur a single plane into a new FloatProcessor.
 
-def gaussianFilter(imp, sigmaX=30, sigmaY=30, sigmaZ=1):
+    Args:
+        ip (ImageProcessor): The input plane, which is not changed.
+        sigmaX (int, optional): The standard deviation of the gaussian in x. Defaults to 30.
+        sigmaY (int, optional): The standard deviation of the gaussian in y. Defaults to 30.
+        tolerance (float, optional): Blur a downsampled copy with this relative error, see
+            blurbackground(). Defaults to None (exact).
+
+    Returns:
+        FloatProcessor: The blurred plane.
+    """
+    if tolerance is None:
+        fp = _floatcopy(ip)
+        GaussianBlur().blurGaussian(fp, sigmaX, sigmaY, 0.0002)
+        return fp
+
+    width, height = ip.getWidth(), ip.getHeight()
+    smallwidth, smallheight = _downsampledsize(width, height, sigmaX, sigmaY, tolerance)
+    small = ip.convertToFloatProcessor().resize(smallwidth, smallheight, True)
+    GaussianBlur().blurGaussian(small, sigmaX * float(smallwidth) / width,
+                                sigmaY * float(smallheight) / height, 0.0002)
+    small.setInterpolationMethod(ImageProcessor.BILINEAR)
+    return small.resize(width, height)
+
+
+def blurbackground(imp, sigmaX=30, sigmaY=30, sigmaZ=0, tolerance=0.01, nthreads=None,
+                   cache=None, source=None, channel=1):
+    """Approximate the gaussian blurred background of a stack on a
+downsampled copy.
+
+    At large radii the blurred background is so smooth that it can be
+computed at a fraction of the resolution: every plane is downsampled
+(averaging blocks of pixels), blurred with sigmas scaled down by the
+same factor, and interpolated back up when it is needed. The
+downsampling factor is the largest that keeps the scaled down sigma
+above sqrt(1 / (8 * tolerance)) pixels, which bounds the relative error
+of the bilinear interpolation by about the tolerance. Only the small
+stack is kept in memory; sigmaZ blurs it along z.
+
+    Args:
+        imp (ImagePlus): The input stack.
+        sigmaX (int, optional): The standard deviation of the gaussian in x. Defaults to 30.
+        sigmaY (int, optional): The standard deviation of the gaussian in y. Defaults to 30.
+        sigmaZ (int, optional): The standard deviation of the gaussian in z. Defaults to 0.
+        tolerance (float, optional): The accepted relative error. Defaults to 0.01.
+        nthreads (int, optional): The number of planes downsampled at the same time. Virtual stacks
+            are read by a single thread. Defaults to None.
+        cache (BackgroundCache, optional): Load the small stack from, or save it to, this cache.
+            Defaults to None.
+        source (str, optional): The source file of imp, for the cache key. Defaults to None.
+        channel (int, optional): The channel of the source that imp holds. Defaults to 1.
+
+    Returns:
+        function: Returns the full size background FloatProcessor of a 1-based stack index.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    stack = imp.getStack()
+
+    # The largest downsampling factor within the tolerance.
+    smallwidth, smallheight = _downsampledsize(width, height, sigmaX, sigmaY, tolerance)
+    sx, sy = sigmaX * float(smallwidth) / width, sigmaY * float(smallheight) / height
+
+    def _downsample(n):
+        ip = stack.getProcessor(n).convertToFloatProcessor()
+        ip = ip.resize(smallwidth, smallheight, True)
+        if sigmaZ <= 0:
+            GaussianBlur().blurGaussian(ip, sx, sy, 0.0002)
+        return ip
+
+    def _blur():
+        # Downsample (and blur) the planes into the small stack.
+        small = ImageStack(smallwidth, smallheight)
+        for ip in processplanes(_downsample, stack.getSize(), readthreads(stack, nthreads)):
+            small.addSlice(ip)
+
+        # Blur the small stack along z as well.
+        impsmall = ImagePlus("background", small)
+        impsmall.setDimensions(nChannels, nSlices, nFrames)
+        if sigmaZ > 0:
+            GaussianBlur3D.blur(impsmall, sx, sy, sigmaZ)
+        return impsmall
+
+    params = {"sigmaX": sigmaX, "sigmaY": sigmaY, "sigmaZ": sigmaZ, "tolerance": tolerance}
+    small = _cachedbackground(cache, imp, source, channel, "gaussian", params, _blur).getStack()
+
+    def _background(n):
+        ip = small.getProcessor(n)
+        ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+        return ip.resize(width, height)
+
+    return _background
+
+
+def gaussianFilter(imp, sigmaX=30, sigmaY=30, sigmaZ=1, square=False, saturated=None, bitDepth=32,
+                   tolerance=None, nthreads=None, cache=None, source=None, channel=1):
     """This function takes an ImagePlus input stack and from each
 individual frame subtracts its gaussian filtered projection. Only works
 for single channel images. The gaussian filter removes uneven
@@ -458,21 +1702,74 @@ better than the rolling ball filter.
         sigmaX (int, optional): The standard deviation (radius) of gaussian distribution in the x direction. Defaults to 30.
         sigmaY (int, optional): The standard deviation (radius) of gaussian distribution in the y direction. Defaults to 30.
         sigmaZ (int, optional): The standard deviation (radius) of gaussian distribution in the z direction. Defaults to 1.
+        square (bool, optional): Square the pixel values after subtraction. Defaults to False.
+        saturated (float, optional): Normalise the contrast with this percentage of saturated pixels.
+            Defaults to None, see subtractbackground().
+        bitDepth (int, optional): The output bit depth. Defaults to 32.
+        tolerance (float, optional): Approximate the gaussian filter on a downsampled copy with this
+            relative error, see blurbackground(). Much faster for large sigmas, and the input is not
+            duplicated. Defaults to None (exact).
+        nthreads (int, optional): Number of planes processed at the same time. Defaults to None.
+        cache (BackgroundCache, optional): Reuse the blurred background of an earlier run from this
+            cache. Only the approximate background, and the exact one with sigmaZ, are cached.
+            Defaults to None.
+        source (str, optional): The source file of imp, for the cache key. Defaults to None.
+        channel (int, optional): The channel of the source that imp holds. Defaults to 1.
 
     Returns:
         ImagePlus: The gaussianfiltered stack.
     """
-    # Store image calibration
-    cal = imp.getCalibration()
+    background = gaussianbackground(imp, sigmaX, sigmaY, sigmaZ, tolerance, nthreads,
+                                    cache, source, channel)
 
-    # Duplicate input ImagePlus
-    gaussian = imp.duplicate()
+    # Subtract gaussian filter plane by plane and return output ImagePlus.
+    return subtractbackground(imp, background, square, saturated, bitDepth, nthreads=nthreads)
 
-    # Perform the gaussian filter with input radius.
-    GaussianBlur3D.blur(gaussian, sigmaX, sigmaY, sigmaZ)
 
-    # Subtract gaussian filter and return output ImagePlus.
-    impout = ImageCalculator().run("Subtract create 32-bit stack", 
-                                   imp, gaussian)
-    impout.setCalibration(cal)
-    return impout
+def gaussianbackground(imp, sigmaX=30, sigmaY=30, sigmaZ=1, tolerance=None, nthreads=None,
+                       cache=None, source=None, channel=1):
+    """The gaussian blurred background of a stack, as used by
+gaussianFilter().
+
+    Args:
+        imp (ImagePlus): The input ImagePlus stack.
+        sigmaX (int, optional): The standard deviation of the gaussian in x. Defaults to 30.
+        sigmaY (int, optional): The standard deviation of the gaussian in y. Defaults to 30.
+        sigmaZ (int, optional): The standard deviation of the gaussian in z. Defaults to 1.
+        tolerance (float, optional): Approximate the blur on a downsampled copy with this relative
+            error, see blurbackground(). Defaults to None (exact).
+        nthreads (int, optional): Number of planes processed at the same time. Defaults to None.
+        cache (BackgroundCache, optional): Reuse the blurred background of an earlier run from this
+            cache. Only the approximate background, and the exact one with sigmaZ, are cached.
+            Defaults to None.
+        source (str, optional): The source file of imp, for the cache key. Defaults to None.
+        channel (int, optional): The channel of the source that imp holds. Defaults to 1.
+
+    Returns:
+        ImageStack or function: The blurred stack (exact, with sigmaZ), or a function returning
+            the background plane for a 1-based stack index, see subtractbackground().
+    """
+    if tolerance is not None:
+        return blurbackground(imp, sigmaX, sigmaY, sigmaZ, tolerance, nthreads,
+                              cache, source, channel)
+
+    if sigmaZ <= 0:
+        # Without a blur along z every plane is its own background, so
+        # the planes are blurred in parallel without a duplicate.
+        stack = imp.getStack()
+
+        def _background(n):
+            return blurplane(stack.getProcessor(n), sigmaX, sigmaY)
+
+        return _background
+
+    def _blur():
+        # Duplicate input ImagePlus
+        gaussian = imp.duplicate()
+
+        # Perform the gaussian filter with input radius.
+        GaussianBlur3D.blur(gaussian, sigmaX, sigmaY, sigmaZ)
+        return gaussian
+
+    params = {"sigmaX": sigmaX, "sigmaY": sigmaY, "sigmaZ": sigmaZ, "tolerance": None}
+    return _cachedbackground(cache, imp, source, channel, "gaussian", params, _blur).getStack()
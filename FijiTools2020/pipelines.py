@@ -0,0 +1,178 @@
+# Jorik van Rijn <jorik.vanrijn@gmail.com> - 2020
+import os
+import ij.io.Opener as Opener
+import ij.io.FileSaver as FileSaver
+from FijiTools2020.stages import (runstages, SubtractProjection, SubtractGaussian, Square,
+                                  GlidingProjection, Convert, Despeckle)
+
+
+# The number of frames the median backgrounds are projected from. Longer
+# movies are subsampled evenly, so their projection fits in memory.
+MAXFRAMES = 1000
+
+# The stages of every output channel, as (source channel, stages) pairs,
+# see FijiTools2020.stages.runstages().
+GAUSSIAN = [
+    # DIC: subtract the gaussian blurred background.
+    (1, [SubtractGaussian(30, 30, 1), Convert(8)]),
+    # Fluorescence: gliding median projection of every 3 frames.
+    (2, [GlidingProjection(3, "Median"), Convert(8)])]
+
+TEMPORAL = [
+    # DIC: subtract the median projection.
+    (1, [SubtractProjection("Median", MAXFRAMES), Convert(8)]),
+    # Fluorescence: gliding median projection of every 3 frames.
+    (2, [GlidingProjection(3, "Median"), Convert(8)])]
+
+TMSQUARED = [
+    # DIC: subtract the gaussian blurred background.
+    (1, [SubtractGaussian(30, 30, 1), Convert(8, saturated=0.3)]),
+    # Moving particles: the cleaned DIC, median subtracted and squared.
+    # This continues from channel 1, see runstages().
+    (1, [SubtractGaussian(30, 30, 1), Convert(8, saturated=0.3),
+         SubtractProjection("Median", MAXFRAMES), Square(), Convert(8, saturated=0.3), Despeckle()])]
+
+DICBACTERIA = [
+    # DIC: normalised.
+    (1, [Convert(8, saturated=0.3)]),
+    # Moving bacteria: the DIC, median subtracted and squared. This
+    # replaces channel 2.
+    (1, [SubtractProjection("Median", MAXFRAMES), Square(), Convert(8, saturated=0.3)])]
+
+
+def withchannels(pipeline, imp, first=3):
+    """Append the channels of imp from first on to a pipeline, so they
+are kept in the result like the merges of the original scripts kept
+them. 8-bit channels are passed through unchanged, others are
+converted to 8-bit.
+
+    Args:
+        pipeline (list): (source channel, stages) pairs.
+        imp (ImagePlus): The input hyperstack.
+        first (int, optional): The first channel to keep. Defaults to 3.
+
+    Returns:
+        list: The pipeline with the kept channels.
+    """
+    stages = [] if imp.getBitDepth() == 8 else [Convert(8)]
+    return pipeline + [(c, list(stages)) for c in range(first, imp.getNChannels() + 1)]
+
+
+def gaussian(imp, cache=None, source=None):
+    """The FlexFormat-gaussian pipeline. The first (DIC) channel is
+filtered to remove non-mobile background using a gaussian filter. The
+second (fluorescent) channel is filtered to remove all swimming bacteria
+using a gliding median projection of every 3 frames.
+
+    Args:
+        imp (ImagePlus): A two-channel stack from the Flexoscope.
+        cache (BackgroundCache, optional): Reuse the backgrounds of an earlier run. Defaults to None.
+        source (str, optional): The file imp was opened from, for the cache key. Defaults to None.
+
+    Returns:
+        ImagePlus: The merged, 8-bit result, with any further channels kept.
+    """
+    return runstages(imp, withchannels(GAUSSIAN, imp), cache=cache, source=source)
+
+
+def temporal(imp, cache=None, source=None):
+    """The FlexFormat-temporal pipeline. The first (DIC) channel is
+filtered to remove non-mobile background using a median filter. The
+second (fluorescent bacteria) channel is filtered to remove all swimming
+bacteria using a gliding median projection of every 3 frames.
+
+    Args:
+        imp (ImagePlus): A two-channel stack from the Flexoscope.
+        cache (BackgroundCache, optional): Reuse the backgrounds of an earlier run. Defaults to None.
+        source (str, optional): The file imp was opened from, for the cache key. Defaults to None.
+
+    Returns:
+        ImagePlus: The merged, 8-bit result, with any further channels kept.
+    """
+    return runstages(imp, withchannels(TEMPORAL, imp), cache=cache, source=source)
+
+
+def tmsquared(imp, cache=None, source=None):
+    """The FlexFormat-TMsquared pipeline. The DIC channel is filtered to
+remove non-mobile background using a gaussian filter. Then, this cleaned
+channel is temporal median filtered and subsequently pixelvalues are
+squared. This extracts moving particles from real-time DIC movies, and
+is appended as channel 2 for particle tracking using TrackMate.
+
+    Args:
+        imp (ImagePlus): A single-channel DIC stack from the Flexoscope.
+        cache (BackgroundCache, optional): Reuse the backgrounds of an earlier run. Defaults to None.
+        source (str, optional): The file imp was opened from, for the cache key. Defaults to None.
+
+    Returns:
+        ImagePlus: The merged, 8-bit result.
+    """
+    return runstages(imp, TMSQUARED, cache=cache, source=source)
+
+
+def dicbacteria(imp, cache=None, source=None):
+    """The DICBacteriaExtractor pipeline. The median projection of the
+DIC channel is subtracted and squared to extract moving bacteria, which
+replace channel 2. Any further channels are kept.
+
+    Args:
+        imp (ImagePlus): A stack from the Flexoscope with DIC as channel 1.
+        cache (BackgroundCache, optional): Reuse the backgrounds of an earlier run. Defaults to None.
+        source (str, optional): The file imp was opened from, for the cache key. Defaults to None.
+
+    Returns:
+        ImagePlus: The merged, 8-bit result.
+    """
+    return runstages(imp, withchannels(DICBACTERIA, imp), cache=cache, source=source)
+
+
+# Pipeline name: function pairs, as used by the batch runner.
+PIPELINES = {"gaussian": gaussian, "temporal": temporal,
+             "tmsquared": tmsquared, "dicbacteria": dicbacteria}
+
+
+def outputpath(inpath, outdir):
+    """The .tif path in outdir that a pipeline writes the result of
+inpath to.
+
+    Args:
+        inpath (path): The input image path.
+        outdir (path): The output directory.
+
+    Returns:
+        path: The output path.
+    """
+    name = os.path.basename(inpath)
+    for ext in (".ome.tiff", ".ome.tif", ".tiff", ".tif"):
+        if name.lower().endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return os.path.join(outdir, name + ".tif")
+
+
+def runpipeline(name, inpath, outdir, cache=None):
+    """Open an image, run a pipeline on it and save the result.
+
+    The result is written to a temporary file that is renamed when
+complete, so an interrupted run never leaves an output that looks
+finished.
+
+    Args:
+        name (str): A pipeline name in PIPELINES.
+        inpath (path): The input image path.
+        outdir (path): The output directory.
+        cache (BackgroundCache, optional): Reuse the backgrounds of an
+            earlier run. Defaults to None.
+
+    Returns:
+        path: The output path.
+    """
+    outpath = outputpath(inpath, outdir)
+    imp = Opener.openUsingBioFormats(inpath)
+    merge = PIPELINES[name](imp, cache, inpath)
+
+    partpath = outpath + ".part"
+    if not FileSaver(merge).saveAsTiff(partpath):
+        raise IOError("Could not save {}".format(outpath))
+    os.rename(partpath, outpath)
+    return outpath
@@ -0,0 +1,308 @@
+# Jorik van Rijn <jorik.vanrijn@gmail.com> - 2020
+import copy
+import ij.IJ as IJ
+import ij.ImagePlus as ImagePlus
+import ij.ImageStack as ImageStack
+import ij.CompositeImage as CompositeImage
+import ij.plugin.filter.RankFilters as RankFilters
+from FijiTools2020.impActions import (PlaneStack, processplanes, projectbackground, projectwindow,
+                                      gaussianbackground, backgroundplanes, displayrange, convertplane,
+                                      _subtractplane, _floatcopy, _keepplanes)
+from FijiTools2020.fileHandling import readthreads, sourcepath
+
+
+class Stage(object):
+    """A single per-channel processing step of a stage pipeline.
+
+    Stages do not pass whole stacks to each other. Every stage computes
+one output plane at a time from a source function, which returns the
+output plane of the previous stage for a 1-based plane index. A chain
+of stages therefore only holds a few planes (and the state of its
+stages, like a background plane) at a time, see runstages(). Stages
+that need all planes of their source see them as a virtual stack, so
+they can use the impActions functions.
+
+    Subclasses override plane(), and prepare() if they need a pass over
+their source first. Stages whose prepare() reads the source planes that
+plane() reads again set firstpass, so runstages() keeps those planes
+instead of computing them twice. plane() must not change the planes it
+gets from the source.
+    """
+
+    firstpass = False
+
+    def __eq__(self, other):
+        # Stages with the same parameters compute the same planes.
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def identity(self):
+        """The name and parameters of the stage, as part of the cache key
+        of the stages after it.
+
+        Returns:
+            list: The class name and a dict of the parameters.
+        """
+        return [type(self).__name__, self.__dict__]
+
+    def prepare(self, source, nplanes, nslices, nthreads=None, cache=None, sourcefile=None, channel=None):
+        """Compute the state the stage needs before its first plane.
+
+        Args:
+            source (function): Returns the source plane for a 1-based plane index.
+            nplanes (int): The number of planes of the channel.
+            nslices (int): The number of z-slices per frame.
+            nthreads (int, optional): The number of planes processed at the same time.
+            cache (BackgroundCache, optional): Load a computed background from, or save it to,
+                this cache. Defaults to None.
+            sourcefile (str, optional): The source image file, for the cache key. Defaults to None.
+            channel (int or list, optional): The source channel, with the identity() of the
+                stages before this one, for the cache key. Defaults to None.
+        """
+        pass
+
+    def plane(self, n, source):
+        """Compute an output plane. The base stage passes the source plane
+through unchanged.
+
+        Args:
+            n (int): The 1-based plane index, frame by frame and z-slice by z-slice.
+            source (function): Returns the source plane for a 1-based plane index.
+
+        Returns:
+            ImageProcessor: The output plane.
+        """
+        return source(n)
+
+
+def _sourceimage(source, nplanes, nslices):
+    # The planes of a source function as single-channel virtual hyperstack,
+    # so the impActions functions can be run on them.
+    first = source(1)
+    stack = PlaneStack(first.getWidth(), first.getHeight(), nplanes, source, first.getBitDepth())
+    imp = ImagePlus("source", stack)
+    imp.setDimensions(1, nslices, nplanes // nslices)
+    return imp
+
+
+class SubtractProjection(Stage):
+    """Subtract a projection of all frames, like subtractzproject().
+Every z-slice gets its own background, see projectbackground()."""
+
+    firstpass = True
+
+    def __init__(self, projectionMethod="Median", maxframes=None):
+        self.projectionMethod = projectionMethod
+        self.maxframes = maxframes
+        self.backgrounds = None
+
+    def prepare(self, source, nplanes, nslices, nthreads=None, cache=None, sourcefile=None, channel=None):
+        background = projectbackground(_sourceimage(source, nplanes, nslices),
+                                       self.projectionMethod, self.maxframes,
+                                       cache, sourcefile, channel)
+        if isinstance(background, ImageStack):
+            background = [background.getProcessor(z) for z in range(1, nslices + 1)]
+        else:
+            background = [background]
+        self.backgrounds = [ip.convertToFloatProcessor() for ip in background]
+
+    def plane(self, n, source):
+        return _subtractplane(source(n), self.backgrounds[(n - 1) % len(self.backgrounds)])
+
+
+class SubtractGaussian(Stage):
+    """Subtract the gaussian blurred background, like gaussianFilter(),
+see gaussianbackground(). The exact blur with sigmaZ keeps a blurred
+copy of the channel at its own bit depth; with a tolerance only a
+downsampled copy is kept."""
+
+    def __init__(self, sigmaX=30, sigmaY=30, sigmaZ=1, tolerance=None):
+        self.sigmaX = sigmaX
+        self.sigmaY = sigmaY
+        self.sigmaZ = sigmaZ
+        self.tolerance = tolerance
+        self.firstpass = sigmaZ > 0 or tolerance is not None
+        self.background = None
+
+    def prepare(self, source, nplanes, nslices, nthreads=None, cache=None, sourcefile=None, channel=None):
+        self.background = backgroundplanes(gaussianbackground(
+            _sourceimage(source, nplanes, nslices), self.sigmaX, self.sigmaY, self.sigmaZ,
+            self.tolerance, nthreads, cache, sourcefile, channel))
+
+    def plane(self, n, source):
+        return _subtractplane(source(n), self.background(n))
+
+
+class Square(Stage):
+    """Square the pixel values, like "Square"."""
+
+    def plane(self, n, source):
+        fp = _floatcopy(source(n))
+        fp.sqr()
+        return fp
+
+
+class GlidingProjection(Stage):
+    """Project every frame with the next frames of the same z-slice, like
+glidingprojection(). Every output plane is projected from its own
+window with projectwindow(), so no projected planes are kept."""
+
+    def __init__(self, window=3, projectionMethod="Median"):
+        self.window = window
+        self.projectionMethod = projectionMethod
+        self.stack = None
+        self.nslices = None
+
+    def prepare(self, source, nplanes, nslices, nthreads=None, cache=None, sourcefile=None, channel=None):
+        self.stack = _sourceimage(source, nplanes, nslices).getStack()
+        self.nslices = nslices
+
+    def plane(self, n, source):
+        # The same z-slice in this and the next frames, clipped at the
+        # last frame.
+        last = min(n + self.window * self.nslices, self.stack.getSize())
+        return projectwindow(self.stack, range(n, last + 1, self.nslices), self.projectionMethod)
+
+
+class Convert(Stage):
+    """Normalise the contrast and convert to a bit depth, like "Enhance
+Contrast..." followed by "8-bit", see subtractbackground()."""
+
+    def __init__(self, bitDepth=8, saturated=None):
+        self.bitDepth = bitDepth
+        self.saturated = saturated
+        self.firstpass = saturated is not None
+        self.range = None
+
+    def prepare(self, source, nplanes, nslices, nthreads=None, cache=None, sourcefile=None, channel=None):
+        self.range = displayrange(lambda n: _floatcopy(source(n)), nplanes,
+                                  self.saturated, self.bitDepth, nthreads)
+
+    def plane(self, n, source):
+        lo, hi = self.range
+        return convertplane(_floatcopy(source(n)), lo, hi, self.bitDepth, self.saturated)
+
+
+class Despeckle(Stage):
+    """A 3x3 median filter, like "Despeckle"."""
+
+    def plane(self, n, source):
+        ip = source(n).duplicate()
+        RankFilters().rank(ip, 1, RankFilters.MEDIAN)
+        return ip
+
+
+def _bind(stage, source):
+    # The output plane function of a stage.
+    def _plane(n):
+        return stage.plane(n, source)
+    return _plane
+
+
+def runstages(imp, pipeline, nthreads=None, cache=None, source=None):
+    """Run a stage pipeline on a hyperstack in one streaming pass per
+output channel.
+
+    The pipeline declares the stages of every output channel. The stages
+of a channel are fused: each output plane is pulled through the whole
+chain, so no intermediate stack is made between the stages and every
+plane is written straight into the output hyperstack. The source
+planes of a stage that needs a pass over all planes first (a
+projection, a contrast range) are kept as far as they fit in memory,
+so the stages before it run once. A channel whose stages start with
+all stages of an earlier output channel of the same source channel
+continues from that output. The planes of a channel are processed in
+parallel. With a cache, the backgrounds of the stages are reused from
+earlier runs on the same source file.
+
+    Args:
+        imp (ImagePlus): The input hyperstack.
+        pipeline (list): (source channel, [Stage, ...]) pairs, one for
+            every output channel. A source channel can be used more than
+            once, and without stages it is passed through unchanged. All
+            channels must end at the same bit depth.
+        nthreads (int, optional): The number of planes processed at the
+            same time. Virtual stacks are read by a single thread.
+            Defaults to None (ImageJ's thread setting).
+        cache (BackgroundCache, optional): Load the backgrounds of the
+            stages from, or save them to, this cache. Defaults to None.
+        source (str, optional): The source file of imp, for the cache
+            key. Defaults to None (the file imp was opened from).
+
+    Returns:
+        ImagePlus: The output hyperstack.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    if cache is not None and source is None:
+        source = sourcepath(imp)
+    stack = imp.getStack()
+    nthreads = readthreads(stack, nthreads)
+    nplanes = nSlices * nFrames
+    outC = len(pipeline)
+    outstack = ImageStack(width, height, outC * nplanes)
+    bitdepth = None
+
+    for i, (c, stages) in enumerate(pipeline):
+        # The planes of the source channel, frame by frame and z-slice by
+        # z-slice.
+        indices = [imp.getStackIndex(c, z, t)
+                   for t in range(1, nFrames + 1) for z in range(1, nSlices + 1)]
+
+        def _source(n, indices=indices):
+            return stack.getProcessor(indices[n - 1])
+
+        # Continue from the longest earlier output channel that ran the
+        # first stages of this one.
+        planes = _source
+        done = 0
+        for j, (c0, stages0) in enumerate(pipeline[:i]):
+            if c0 == c and done < len(stages0) and stages[:len(stages0)] == stages0:
+                def _source(n, j=j):
+                    return outstack.getProcessor((n - 1) * outC + j + 1)
+                planes = _source
+                done = len(stages0)
+
+        # Chain the stages. The stages are copied, so a pipeline can be
+        # declared once and run many times. The memory for the kept
+        # planes is shared by the stages of the channel.
+        remaining = [copy.copy(stage) for stage in stages[done:]]
+        nkept = len([stage for stage in remaining if stage.firstpass])
+        if nkept:
+            maxbytes = (IJ.maxMemory() - IJ.currentMemory()) // (2 * nkept)
+        for k, stage in enumerate(remaining, done):
+            if stage.firstpass:
+                planes = _keepplanes(planes, 4 * width * height, maxbytes)
+            # The background of a stage depends on the stages before it.
+            channel = c if not k else [c] + [s.identity() for s in stages[:k]]
+            stage.prepare(planes, nplanes, nSlices, nthreads, cache, source, channel)
+            planes = _bind(stage, planes)
+
+        # Put every plane at its (c, z, t) position as it is done. Planes
+        # that no stage made are copied, so they are not shared.
+        def _putplane(n, planes=planes, i=i, copyplane=not remaining):
+            ip = planes(n)
+            if copyplane:
+                ip = ip.duplicate()
+            outstack.setPixels(ip.getPixels(), (n - 1) * outC + i + 1)
+            return ip.getBitDepth()
+
+        depths = set(processplanes(_putplane, nplanes, nthreads))
+        if bitdepth is None:
+            bitdepth = depths.pop()
+        if depths - set([bitdepth]):
+            raise ValueError("All channels must end at the same bit depth")
+
+    impout = ImagePlus(imp.getTitle(), outstack)
+    impout.setDimensions(outC, nSlices, nFrames)
+    if outC > 1:
+        impout = CompositeImage(impout, CompositeImage.COMPOSITE)
+        # Keep the source colours, unless a channel is used twice.
+        channels = [c for c, stages in pipeline]
+        if imp.isComposite() and len(set(channels)) == outC:
+            luts = imp.getLuts()
+            impout.setLuts([luts[c - 1] for c in channels])
+    impout.setOpenAsHyperStack(True)
+    impout.setCalibration(imp.getCalibration().copy())
+    return impout
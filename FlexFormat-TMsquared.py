@@ -10,32 +10,19 @@
 
 import ij.IJ as IJ
 import ij.io.Opener as Opener
-import ij.plugin.RGBStackMerge as RGBStackMerge
-from FijiTools2020.impActions import gaussianFilter, subtractzproject
+from FijiTools2020.fileHandling import BackgroundCache
+from FijiTools2020.pipelines import tmsquared
 
 
 def main():
     # Open a .ome.tif image from the Flexoscope.
     impath = IJ.getFilePath("Choose .ome.tiff file")
     imp = Opener.openUsingBioFormats(impath)
-    cal = imp.getCalibration()
 
-    # Process DIC.
-    imp = gaussianFilter(imp)
-    IJ.run(imp, "Enhance Contrast...", 
-           "saturated=0.3 normalize process_all use")
-    IJ.run(imp, "8-bit", "") 
-    tm_sqr = subtractzproject(imp)
-    IJ.run(tm_sqr, "Square", "stack")
-    IJ.run(tm_sqr, "Enhance Contrast...", 
-           "saturated=0.3 normalize process_all use")
-    IJ.run(tm_sqr, "8-bit", "") 
-    IJ.run(tm_sqr, "Despeckle", "")
-    channels = [imp, tm_sqr]
-
-    # Merge channels.
-    merge = RGBStackMerge().mergeChannels(channels, True)  # boolean keep
-    merge.setCalibration(cal)
+    # Process and merge the channels, see FijiTools2020.pipelines. The
+    # backgrounds are cached, so running the script again on the same
+    # file skips computing them.
+    merge = tmsquared(imp, BackgroundCache(), impath)
     merge.show()
 
 
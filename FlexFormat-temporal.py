@@ -7,35 +7,20 @@
 
 import ij.IJ as IJ
 import ij.io.Opener as Opener
-import ij.plugin.ChannelSplitter as ChannelSplitter
-import ij.plugin.RGBStackMerge as RGBStackMerge
-from FijiTools2020.impActions import subtractzproject, glidingprojection
+from FijiTools2020.fileHandling import BackgroundCache
+from FijiTools2020.pipelines import temporal
 
 
 def main():
     # Open a .ome.tif image from the Flexoscope.
     impath = IJ.getFilePath("Choose .ome.tiff file")
-    channels = Opener.openUsingBioFormats(impath)
-    cal = channels.getCalibration()
+    imp = Opener.openUsingBioFormats(impath)
 
-    # Split channels.
-    channels = ChannelSplitter().split(channels)
-
-    # Process channel 1.
-    channels[0] = subtractzproject(channels[0])
-    IJ.run(channels[0], "8-bit", "") 
-
-    # Process channel 2. 
-    channels[1] = glidingprojection(channels[1]) 
-    IJ.run(channels[1], "8-bit", "") 
-
-    # [Optional] Process channel 3, 4, etc.
-
-    # Merge channels.
-    merge = RGBStackMerge().mergeChannels(channels, True) # boolean keep
-    merge.setCalibration(cal)
+    # Process and merge the channels, see FijiTools2020.pipelines. The
+    # backgrounds are cached, so running the script again on the same
+    # file skips computing them.
+    merge = temporal(imp, BackgroundCache(), impath)
     merge.show()
 
 
 main()
-
@@ -5,9 +5,11 @@ import ij.plugin.ChannelSplitter as ChannelSplitter
 import ij.plugin.RGBStackMerge as RGBStackMerge
 import ij.plugin.ZProjector as ZProjector
 import ij.plugin.ImageCalculator as ImageCalculator
-import ij.plugin.GaussianBlur3D as GaussianBlur3D
 import ij.plugin.ContrastEnhancer as ContrastEnhancer
 import ij.process.ImageConverter as ImageConverter
+from FijiTools2020.fileHandling import (ImageWriter, JobManifest, BackgroundCache, backgroundkey,
+                                         paramchecksum, parallelmap, tifpath)
+from FijiTools2020.impActions import blurbackground, subtractbackground
 # from FijiTools2020.impActions import subtractzproject, glidingprojection
 
 
@@ -42,39 +44,81 @@ def stackCalc(imp, operation="subtract", c1=2, c2=3):
     return merge
 
 
+# The parameters of the open, cross-excitation, projection and
+# background steps. Their result is kept in the intermediate cache, so
+# changing only the output parameters skips these steps.
+PARAMS = {"subtract": [2, 3], "projection": "max", "sigma": 100, "tolerance": 0.01}
+# The parameters of the final contrast stretch.
+OUTPUT_PARAMS = {"saturated": 0.0}
+# The number of files processed at the same time.
+NWORKERS = 2
+
+
+def process(impath):
+    # Open an .ome.tif image from the Flexoscope.
+    imp = Opener.openUsingBioFormats(impath)
+
+    # Correct cross-excitation.
+    c1, c2 = PARAMS["subtract"]
+    imp = stackCalc(imp, "subtract", c1, c2)
+
+    # Make z-projection.
+    imp = ZProjector.run(imp, PARAMS["projection"])
+
+    # Remove background. At sigma 100 the blurred background is
+    # approximated on a downsampled copy.
+    sigma = PARAMS["sigma"]
+    gaussian = blurbackground(imp, sigma, sigma, 1, tolerance=PARAMS["tolerance"])
+    return subtractbackground(imp, gaussian, bitDepth=32, operation="divide")
+
+
 def main():
     # Open an .ome.tif image from the Flexoscope.
     imdir = IJ.getDir("Choose .ome.tiff files")
     outdir = IJ.getDir("Choose .ome.tiff files")
 
+    inputs = []
     for root, dirs, files in os.walk(imdir, topdown=False):
-       for name in files:
-           if name.endswith(".ome.tif"):
-               impath = os.path.join(root, name)
-               imp = Opener.openUsingBioFormats(impath)
-
-               # Correct cross-excitation.
-               imp = stackCalc(imp, "subtract", 2, 3)
-               
-               # Make z-projection.
-               imp = ZProjector.run(imp,"max")
-
-               # Remove background.
-               gaussian = imp.duplicate()
-               GaussianBlur3D.blur(gaussian, 100, 100, 1)
-               imp = ImageCalculator().run("divide 32-bit create stack", 
-                                           imp, gaussian)
-               
-               # Reset display range and convert to 8-bit.
-               dims = imp.getDimensions() # width, height, nChannels, nSlices, nFrames               
-               for channel in range(1, dims[2]+1):
-                   imp.setC(channel)  
-                   ContrastEnhancer().stretchHistogram(imp, 0.0)
-            #    imp = ImageConverter(imp).convertToGray16()
-               
-               IJ.log("{}".format(name))
-               outpath = os.path.join(outdir, name)
-               IJ.saveAs(imp, "Tiff", outpath)
-
-
-main()
\ No newline at end of file
+        for name in files:
+            if name.endswith(".ome.tif"):
+                inputs.append(os.path.join(root, name))
+
+    # Skip the files that were completed with the same parameters by an
+    # earlier (interrupted) run.
+    manifest = JobManifest(os.path.join(outdir, "FrankenFormat-manifest.json"))
+    checksum = paramchecksum([PARAMS, OUTPUT_PARAMS])
+    todo = [impath for impath in inputs if not manifest.isdone(impath, checksum)]
+    IJ.log("{} of {} files to process.".format(len(todo), len(inputs)))
+
+    # The background divided projections, reused when only the output
+    # parameters changed. The store keeps one projection per input file
+    # without a size limit, so none of the batch is evicted; delete the
+    # .intermediate directory when the batch is final.
+    intermediates = BackgroundCache(os.path.join(outdir, ".intermediate"), maxbytes=None)
+
+    # Results are saved in the background while the next file is processed.
+    with ImageWriter() as writer:
+
+        def _processfile(impath):
+            key = backgroundkey(impath, None, "FrankenFormat", PARAMS)
+            imp = intermediates.getorcompute(key, lambda: process(impath))
+
+            # Reset display range and convert to 8-bit.
+            dims = imp.getDimensions() # width, height, nChannels, nSlices, nFrames
+            for channel in range(1, dims[2]+1):
+                imp.setC(channel)
+                ContrastEnhancer().stretchHistogram(imp, OUTPUT_PARAMS["saturated"])
+            # imp = ImageConverter(imp).convertToGray16()
+
+            name = os.path.basename(impath)
+            IJ.log("{}".format(name))
+            outpath = tifpath(os.path.join(outdir, name))
+
+            # The file only counts as done once its output is written.
+            writer.save(imp, outpath,
+                        lambda: manifest.markdone(impath, checksum, outpath))
+
+        parallelmap(_processfile, todo, NWORKERS)
+
+
+main()
@@ -4,11 +4,8 @@
 # in the chosen output directory.
 
 # Jorik van Rijn <jorik.vanrijn@gmail.com> - 2020
-import os
 import ij.IJ as IJ
-import ij.io.Opener as Opener
-from FijiTools2020.fileHandling import saveimage
-from FijiTools2020.impActions import makemontage
+from FijiTools2020.impActions import batchmontage
 
 
 def main():
@@ -16,21 +13,11 @@ def main():
     indir = IJ.getDirectory("input directory")
     outdir = IJ.getDirectory("output directory")
 
-    # Collect all files in the import directory and sort on file name.
-    files = sorted(os.listdir(indir))
+    # Make a montage of every .tif file and save it as .tif in the output
+    # directory. Several files are montaged at the same time, see
+    # batchmontage() for the memory budget.
+    failed = batchmontage(indir, outdir, hsize=6, vsize=6, increment=2)
+    IJ.log("\nExecution StackMontage finished, {} failed.".format(len(failed)))
 
-    # Loop through all input files.
-    montages = []
-    for imfile in files:
 
-        # Some optional feedback if you're impatient.
-    	IJ.log("File: {}/{}".format(files.index(imfile)+1, len(files)))
-        
-        # Make montage of every .tiff file and save as .tiff in the output directory.
-        if imfile.endswith(".tif"):
-            imp = Opener().openImage(indir, imfile)
-            montage = makemontage(imp, hsize=6, vsize=6, increment=2)
-            saveimage(montage, outdir)
-
-
-main()
\ No newline at end of file
+main()
@@ -4,9 +4,10 @@
 # resulting cropped stacks will be saved in the chosen output directory.
 #
 # Jorik van Rijn <jorik.vanrijn@gmail.com> - 2020
+import os
 import ij.IJ as IJ
 import ij.WindowManager as WindowManager
-from FijiTools2020.fileHandling import opencsv, getresults
+from FijiTools2020.fileHandling import readcsv, openvirtual, TRACK_COLUMNS
 from FijiTools2020.impActions import croptracks, combinestacks
 
 
@@ -15,20 +16,35 @@ def main():
     # output.
     outdir = IJ.getDirectory("output directory")
 
-    # Open the 'Track statistics.csv' input file and format as
-    # getresults() dictionary.
-    rt = opencsv()
-    rt = getresults(rt)
+    # Stream the 'Track statistics.csv' input file in chunks, skipping
+    # the extra TrackMate header rows and keeping only the columns needed
+    # for cropping. The chunks are consumed by croptracks. The parsed
+    # columns are kept in a sidecar next to the .csv, which a second run
+    # reads instead.
+    csvpath = IJ.getFilePath("Choose the Track statistics.csv file")
+    rt = readcsv(csvpath, TRACK_COLUMNS, chunksize=65536, cache=True)
 
-    # Retrieve the current image as input (source) image.
+    # Retrieve the current image as input (source) image. Without an
+    # open image, read the source from disk as virtual stack instead.
     imp = WindowManager.getCurrentImage()
+    if imp is None:
+        imp = openvirtual()
+    stream = imp.getStack().isVirtual()
 
     # Run the main crop function on the source image.
-    croptracks(imp, tracks=rt, outdir=outdir, roi_x=150, roi_y=150)
-    crop
-
-    # Combine all output stacks into one movie.
-    combinestacks(outdir, height=8)
+    frameoffsets = croptracks(imp, tracks=rt, outdir=outdir, roi_x=150, roi_y=150,
+                              stream=stream)
+
+    # Combine all output stacks into one movie, where every track starts
+    # at its own first frame. For a virtual source the panel is written
+    # plane by plane to montage/Montage.tif, so it does not need to fit
+    # in memory; otherwise it is shown.
+    if stream:
+        combinestacks(outdir, height=8, stream=True,
+                      outdir=os.path.join(outdir, "montage"),
+                      frameoffsets=frameoffsets)
+    else:
+        combinestacks(outdir, height=8, frameoffsets=frameoffsets)
 
 
 # Execute main()